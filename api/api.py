@@ -1,78 +1,298 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
+import hashlib
+import heapq
+import json
+import logging
 import os
 from pathlib import Path
-import types
+import shutil
+import time
 
 from dotenv import load_dotenv
-from fastapi import FastAPI, File, Form, UploadFile
-import ffmpeg
-from pyannote.audio import Pipeline
-import torch
-import whisperx
-
-from srt import create_srt
-from transcription import get_prompt, transcribe
+from fastapi import FastAPI, File, Form, Request, UploadFile
+from fastapi.responses import Response, StreamingResponse
+
+from artifacts import FILE_NAMES, artifact_response, write_artifact
+from audio import decode_audio, get_audio_length
+from backends import InferenceBackend, create_backend
+from checkpoints import Checkpoints, evict_checkpoints
+from estimator import ProcessingTimeEstimator
+from jobs import JobStore
+from leaks import data_leak_patterns
+import metrics
+from scheduler import JobScheduler
+from srt import create_srt, create_vtt
+from transcription import transcribe
 from viewer import create_viewer
 
 from fastapi import FastAPI, File, Form, UploadFile, HTTPException
-from queue import Queue
 import asyncio
 import uuid
-from typing import Dict
+from typing import Dict, Literal
 
 # Add these at the top with other imports
-from dataclasses import dataclass
-from datetime import datetime
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
 
 load_dotenv()
 
 ONLINE = os.getenv("ONLINE") == "True"
 DEVICE = os.getenv("DEVICE")
+# Inference backend: "whisperx" or "stub" (no models, for load tests)
+BACKEND = os.getenv("BACKEND", "whisperx")
+STUB_REAL_TIME_FACTOR = float(os.getenv("STUB_REAL_TIME_FACTOR", "0"))
+# Diarize in a separate thread while the text is transcribed
+DIARIZE_PARALLEL = os.getenv("DIARIZE_PARALLEL", "True") == "True"
+# CPU threads of the transcription and of the PyTorch models (diarization,
+# alignment), 0 keeps the PyTorch default
+ASR_THREADS = int(os.getenv("ASR_THREADS", "4"))
+TORCH_THREADS = int(os.getenv("TORCH_THREADS", "0"))
 ROOT = os.getenv("ROOT")
 BATCH_SIZE = int(os.getenv("BATCH_SIZE"))
-MAX_QUEUE_SIZE = int(os.getenv("MAX_QUEUE_SIZE"))
-PROCESSING = False
+MAX_QUEUE_SIZE = int(os.getenv("MAX_QUEUE_SIZE"))  # per user
+# Queued jobs of all users together, it bounds the spool files on disk
+MAX_TOTAL_QUEUE_SIZE = int(os.getenv("MAX_TOTAL_QUEUE_SIZE", str(10 * MAX_QUEUE_SIZE)))
+WORKERS = int(os.getenv("WORKERS", "1"))
+MAX_USER_WORKERS = int(os.getenv("MAX_USER_WORKERS", str(WORKERS)))
+ALIGN_CACHE_SIZE = int(os.getenv("ALIGN_CACHE_SIZE", "3"))
+ALIGN_PRELOAD = [
+    language.strip()
+    for language in os.getenv("ALIGN_PRELOAD", "").split(",")
+    if language.strip()
+]
+LANGID_BATCH_SIZE = int(os.getenv("LANGID_BATCH_SIZE", "16"))
+# Directory with additional data leak phrases, <language>.txt
+LEAK_PATTERNS_DIR = os.getenv("LEAK_PATTERNS_DIR", f"{ROOT}data/leaks")
+RESULT_TTL_HOURS = float(os.getenv("RESULT_TTL_HOURS", "24"))
+# Reuse the result of an earlier upload of the same audio with the same hotwords
+RESULT_CACHE = os.getenv("RESULT_CACHE", "True") == "True"
+RESULT_CACHE_SIZE_MB = float(os.getenv("RESULT_CACHE_SIZE_MB", "10240"))
+# Keep the decoded audio, voice activity and diarization of every audio file, so a
+# rerun with other hotwords or after a failure only repeats the text related stages
+CHECKPOINTS = os.getenv("CHECKPOINTS", "True") == "True"
+CHECKPOINT_CACHE_SIZE_MB = float(os.getenv("CHECKPOINT_CACHE_SIZE_MB", "20480"))
+CHECKPOINT_TTL_HOURS = float(os.getenv("CHECKPOINT_TTL_HOURS", "24"))
+# Embed the transcript of the viewer as JSON, rendered in the browser
+VIEWER_COMPACT = os.getenv("VIEWER_COMPACT", "False") == "True"
+# Increase when a change of the processing changes the results, so cached results
+# of the old version are not reused.
+RESULT_VERSION = 2
+# Seconds of audio a queued job gains on newer jobs for every second it waits
+SCHEDULER_AGING_RATE = float(os.getenv("SCHEDULER_AGING_RATE", "10"))
+# Record a timing trace of every job, returned in the status as "timings"
+JOB_TRACE = os.getenv("JOB_TRACE", "True") == "True"
+# Jobs slower than this real-time factor are appended to the slow job log, 0 disables
+SLOW_JOB_RTF = float(os.getenv("SLOW_JOB_RTF", "0"))
+SLOW_JOB_LOG = os.getenv("SLOW_JOB_LOG", f"{ROOT}data/slow_jobs.jsonl")
+SPOOL_CHUNK_SIZE = 1024 * 1024
+EVENTS_KEEPALIVE = 15.0
+EVENT_LOOP_LAG_INTERVAL = 1.0
 queue_full_message = "Queue is full. Please try again later."
 
-model = None
-diarize_model = None
-
 
 @dataclass
 class QueueItem:
     id: str
+    user_id: str
     file_name: str
-    file_content: bytes
+    file_path: Path
     hotwords: list[str]
     timestamp: datetime
     status: str = "queued"  # queued, processing, completed, failed
-    result: dict = None
+    stage: str = None
     position: int = 0
     audio_length: float = 0.0
     estimated_wait_time: float = 0.0
     estimated_processing_time: float = 0.0
+    # (stage, time.monotonic()) when each stage of the processing started
+    stage_times: list[tuple[str, float]] = field(default_factory=list)
+    # (stage, start, end) of the stages that ran besides the others, e.g. the
+    # diarization with DIARIZE_PARALLEL
+    parallel_stage_times: list[tuple[str, float, float]] = field(default_factory=list)
+    # Timing trace of the job, None if JOB_TRACE is disabled
+    trace: dict = None
+    cache_key: str = None
+    # Stages whose result was loaded from a checkpoint
+    checkpointed_stages: set[str] = field(default_factory=set)
+
+    def stage_durations(self, finished: float) -> dict[str, float]:
+        ends = [started for _, started in self.stage_times[1:]] + [finished]
+        return {
+            stage: end - started
+            for (stage, started), end in zip(self.stage_times, ends)
+        }
+
+    def timings(self, finished: float = None) -> dict:
+        # The trace with the start and end of every stage in seconds since the
+        # processing started. The current stage has no end yet.
+        origin = self.stage_times[0][1] if self.stage_times else 0.0
+        ends = [started for _, started in self.stage_times[1:]] + [finished]
+        stages = [
+            {
+                "stage": stage,
+                "start": round(started - origin, 3),
+                "end": round(end - origin, 3) if end is not None else None,
+            }
+            for (stage, started), end in zip(self.stage_times, ends)
+        ]
+        stages += [
+            {
+                "stage": stage,
+                "start": round(started - origin, 3),
+                "end": round(end - origin, 3),
+                "parallel": True,
+            }
+            for stage, started, end in self.parallel_stage_times
+        ]
+        return {**self.trace, "stages": stages}
 
 
-request_queue = Queue()
+@dataclass
+class Worker:
+    # Every worker owns its backend, so jobs running in parallel never share
+    # (and reconfigure) the same whisperx pipeline.
+    id: int
+    backend: InferenceBackend = None
+    item: QueueItem = None
+    started: float = 0.0
+
+    def remaining_time(self) -> float:
+        if self.item is None:
+            return 0.0
+        elapsed = time.monotonic() - self.started
+        return max(self.item.estimated_processing_time - elapsed, 0.0)
+
+
+# Queued items, round-robin over the users and shortest job first per user
+request_queue = JobScheduler(SCHEDULER_AGING_RATE, MAX_USER_WORKERS)
 active_requests: Dict[str, QueueItem] = {}
+# Queued and running items by cache key, identical uploads attach to them
+in_flight: dict[str, QueueItem] = {}
+# Number of uploads and requests using a spool file, identical uploads share one
+spool_refs: dict[Path, int] = defaultdict(int)
+workers: list[Worker] = []
+job_store: JobStore = None
+estimator: ProcessingTimeEstimator = None
+# Event stream subscribers per request id
+subscribers: dict[str, set[asyncio.Queue]] = defaultdict(set)
+
+# The blocking transcription pipeline runs in this pool, one thread per worker.
+executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="transcription")
+
+
+def load_backend():
+    return create_backend(
+        BACKEND,
+        DEVICE,
+        hf_auth_token=os.getenv("HF_AUTH_TOKEN"),
+        align_cache_size=max(ALIGN_CACHE_SIZE, len(ALIGN_PRELOAD)),
+        asr_threads=ASR_THREADS,
+        torch_threads=TORCH_THREADS,
+        stub_real_time_factor=STUB_REAL_TIME_FACTOR,
+    )
+
+
+async def evict_results():
+    # Delete result artifacts RESULT_TTL_HOURS after they were last used, and the
+    # least recently used ones while all results exceed RESULT_CACHE_SIZE_MB.
+    # Errors are only logged, the eviction runs in the workers after every job.
+    try:
+        cutoff = datetime.now() - timedelta(hours=RESULT_TTL_HOURS)
+        jobs = job_store.results()
+        total_size = sum(job["result_size"] for job in jobs)
+        for job in jobs:
+            last_used = datetime.fromisoformat(
+                job["last_used_at"] or job["finished_at"]
+            )
+            if last_used >= cutoff and total_size <= RESULT_CACHE_SIZE_MB * 1024 * 1024:
+                break
+            await asyncio.to_thread(
+                shutil.rmtree, Path(ROOT + f"data/out/{job['id']}/"), True
+            )
+            job_store.update(job["id"], artifacts={})
+            total_size -= job["result_size"]
+    except Exception:
+        logger.exception("Evicting results failed")
+
+
+def checkpoint_dir(item: QueueItem) -> Path:
+    # Checkpoints depend on the audio (the spool file is named after its hash) and
+    # the backend.
+    return Path(ROOT + f"data/cache/{BACKEND}/{item.file_path.stem}/")
+
+
+async def purge_results():
+    while True:
+        await evict_results()
+        await asyncio.to_thread(
+            evict_checkpoints,
+            Path(ROOT + "data/cache/"),
+            CHECKPOINT_CACHE_SIZE_MB * 1024 * 1024,
+            CHECKPOINT_TTL_HOURS * 60 * 60,
+            {checkpoint_dir(item) for item in active_requests.values()},
+        )
+        await asyncio.sleep(60 * 60)
+
+
+async def monitor_event_loop():
+    # The event loop lag is how much later than requested a sleep returns.
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        lag = time.monotonic() - started - EVENT_LOOP_LAG_INTERVAL
+        metrics.EVENT_LOOP_LAG_SECONDS.observe(max(lag, 0.0))
+
+
+def resume_jobs():
+    # Requeue the jobs that were queued or running when the API stopped.
+    for job in job_store.unfinished():
+        if not job["file_path"].exists():
+            job_store.update(
+                job["id"],
+                status="failed",
+                finished_at=datetime.now(),
+                error="The uploaded file was lost during a restart.",
+            )
+            continue
+
+        item = QueueItem(
+            id=job["id"],
+            user_id=job["user_id"],
+            file_name=job["file_name"],
+            file_path=job["file_path"],
+            hotwords=job["hotwords"],
+            timestamp=job["created_at"],
+            audio_length=job["audio_length"],
+            estimated_processing_time=estimator.estimate(DEVICE, job["audio_length"]),
+            trace={} if JOB_TRACE else None,
+            cache_key=job["cache_key"],
+        )
+        job_store.update(item.id, status="queued", stage=None, started_at=None)
+        spool_refs[item.file_path] += 1
+        active_requests[item.id] = item
+        if item.cache_key is not None:
+            in_flight[item.cache_key] = item
+        request_queue.put_nowait(item)
+    update_queue_estimates()
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global model, diarize_model
+    global job_store, estimator
 
-    compute_type = "float16" if DEVICE != "cpu" else "float32"
-    model = whisperx.load_model(
-        "large-v3",
-        DEVICE,
-        compute_type=compute_type,
-        download_root="models/whisperx",
-    )
+    for i in range(WORKERS):
+        workers.append(Worker(id=i, backend=load_backend()))
+
+    # The alignment models are shared by all workers
+    workers[0].backend.preload(ALIGN_PRELOAD)
 
-    model.model.get_prompt = types.MethodType(get_prompt, model.model)
-    diarize_model = Pipeline.from_pretrained(
-        "pyannote/speaker-diarization", use_auth_token=os.getenv("HF_AUTH_TOKEN")
-    ).to(torch.device(DEVICE))
+    # Compile the data leak phrases before the first job
+    data_leak_patterns.directory = Path(LEAK_PATTERNS_DIR)
+    data_leak_patterns.get("de")
 
     for directory in [
         Path(ROOT + "data/in/"),
@@ -82,79 +302,318 @@ async def lifespan(app: FastAPI):
     ]:
         directory.mkdir(parents=True, exist_ok=True)
 
-    asyncio.create_task(process_queue())
+    job_store = JobStore(Path(ROOT + "data/jobs.db"))
+    estimator = ProcessingTimeEstimator(job_store)
+    resume_jobs()
+
+    tasks = [asyncio.create_task(process_queue(worker)) for worker in workers]
+    tasks.append(asyncio.create_task(purge_results()))
+    tasks.append(asyncio.create_task(monitor_event_loop()))
 
     yield
-    del model, diarize_model
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    executor.shutdown(wait=False, cancel_futures=True)
+    workers.clear()
+    job_store.close()
 
 
 app = FastAPI(lifespan=lifespan)
 
 
-async def get_audio_length(file_content: bytes, temp_file_path: Path) -> float:
-    # Write temporary file to get duration
-    with temp_file_path.open("wb") as temp_file:
-        temp_file.write(file_content)
+def spool_upload(upload_file, file_name: str) -> tuple[Path, Path]:
+    # Stream the upload in chunks into a part file in ROOT/data/in/. Returns the
+    # part file and the spool file it becomes, named after the hash of its content,
+    # so identical uploads share one file (see acquire_spool).
+    digest = hashlib.sha256()
+    part_path = Path(ROOT + f"data/in/{uuid.uuid4()}.part")
+    try:
+        with part_path.open("wb") as spool_file:
+            while chunk := upload_file.read(SPOOL_CHUNK_SIZE):
+                digest.update(chunk)
+                spool_file.write(chunk)
+    except BaseException:
+        # E.g. the disk is full, nothing else removes part files
+        part_path.unlink(missing_ok=True)
+        raise
+
+    spool_path = Path(ROOT + f"data/in/{digest.hexdigest()}{Path(file_name).suffix}")
+    return part_path, spool_path
+
+
+def acquire_spool(part_path: Path, spool_path: Path) -> Path:
+    # Move the part file to the shared spool file and take a reference to it. Runs
+    # on the event loop like release_spool, so a spool file that is in use is never
+    # deleted in between.
+    spool_refs[spool_path] += 1
+    if spool_path.exists():
+        part_path.unlink()
+    else:
+        part_path.replace(spool_path)
+    return spool_path
+
+
+def release_spool(file_path: Path):
+    # Remove the spool file once no upload or request refers to it anymore.
+    spool_refs[file_path] -= 1
+    if spool_refs[file_path] <= 0:
+        del spool_refs[file_path]
+        file_path.unlink(missing_ok=True)
+
+
+def cache_key(file_path: Path, hotwords: list[str]) -> str:
+    # Uploads of the same audio with the same hotwords, models and data leak phrases
+    # share a result. The spool file is named after the hash of the audio.
+    config = [
+        file_path.stem,
+        hotwords,
+        BACKEND,
+        DEVICE,
+        VIEWER_COMPACT,
+        RESULT_VERSION,
+        data_leak_patterns.version(),
+    ]
+    return hashlib.sha256(json.dumps(config).encode()).hexdigest()
+
+
+def cached_request(key: str) -> str | None:
+    # Id of the queued, running or completed request with this cache key.
+    if key in in_flight:
+        return in_flight[key].id
+
+    job = job_store.cached(key)
+    if job is None or not all(path.exists() for path in job["artifacts"].values()):
+        return None
+    job_store.update(job["id"], last_used_at=datetime.now())
+    return job["id"]
+
+
+def queue_response(request_id: str) -> dict:
+    status = job_status(request_id)
+    return {
+        "request_id": request_id,
+        "position": status["position"],
+        "status": status["status"],
+        "estimated_wait_time": status["estimated_wait_time"],
+        "estimated_processing_time": status["estimated_processing_time"],
+    }
+
+
+def job_status(request_id: str) -> dict | None:
+    # Small status document of a queued, running or finished request.
+    if request_id in active_requests:
+        item = active_requests[request_id]
+        return {
+            "status": item.status,
+            "stage": item.stage,
+            "position": request_queue.position(item.id),
+            "estimated_wait_time": item.estimated_wait_time,
+            "estimated_processing_time": item.estimated_processing_time,
+            "timings": item.timings() if item.trace is not None else None,
+        }
+
+    job = job_store.get(request_id)
+    if job is None:
+        return None
+
+    status = {
+        "status": job["status"],
+        "stage": job["stage"],
+        "position": 0,
+        "estimated_wait_time": 0.0,
+        "estimated_processing_time": job["estimated_processing_time"],
+        "timings": job["timings"],
+    }
+    if job["status"] == "failed":
+        status["error"] = job["error"]
+    return status
+
+
+def finish_trace(worker: Worker, item: QueueItem, finished: float) -> dict | None:
+    # Complete the trace of a finished job, None if tracing is disabled.
+    if item.trace is None:
+        return None
+    timings = item.timings(finished)
+    timings["processing_time"] = round(finished - worker.started, 3)
+    if item.audio_length > 0:
+        timings["real_time_factor"] = round(
+            timings["processing_time"] / item.audio_length, 4
+        )
+    return timings
+
+
+def log_slow_job(item: QueueItem, timings: dict):
+    record = {
+        "id": item.id,
+        "file_name": item.file_name,
+        "status": item.status,
+        "created_at": item.timestamp.isoformat(),
+        "timings": timings,
+    }
+    try:
+        with open(SLOW_JOB_LOG, "a", encoding="utf-8") as log:
+            log.write(json.dumps(record, ensure_ascii=False) + "\n")
+    except OSError:
+        # Called by the worker after a job, it must not stop the worker
+        logger.exception("Writing the slow job log %s failed", SLOW_JOB_LOG)
+
+
+def publish(request_id: str):
+    # Push the current status of a request to its event stream subscribers.
+    if request_id not in subscribers:
+        return
+    status = job_status(request_id)
+    for subscriber in subscribers[request_id]:
+        subscriber.put_nowait(status)
+
+
+def set_stage(item: QueueItem, stage: str):
+    item.stage = stage
+    job_store.update(item.id, stage=stage)
+    publish(item.id)
 
-    # Get audio duration using ffmpeg
-    probe = ffmpeg.probe(str(temp_file_path))
-    duration = float(probe["streams"][0]["duration"])
-    return duration
 
+def queue_full(user_id: str) -> bool:
+    return (
+        request_queue.qsize(user_id) >= MAX_QUEUE_SIZE
+        or request_queue.qsize() >= MAX_TOTAL_QUEUE_SIZE
+    )
+
+
+def update_queue_estimates():
+    # Simulate handing the queued items to the workers in scheduling order. Every
+    # queued item starts as soon as the first worker becomes free.
+    free_at = [worker.remaining_time() for worker in workers]
+    heapq.heapify(free_at)
+    for position, queued_item in enumerate(request_queue.queued(), start=1):
+        start = heapq.heappop(free_at)
+        queued_item.position = position
+        queued_item.estimated_wait_time = start
+        heapq.heappush(free_at, start + queued_item.estimated_processing_time)
+        publish(queued_item.id)
+
+
+async def process_queue(worker: Worker):
+    loop = asyncio.get_running_loop()
+
+    def on_stage(item: QueueItem, stage: str):
+        # Called from the executor thread.
+        item.stage_times.append((stage, time.monotonic()))
+        loop.call_soon_threadsafe(set_stage, item, stage)
+
+    def on_parallel_stage(item: QueueItem, stage: str, start: float, end: float):
+        # Called from the thread of the stage.
+        item.parallel_stage_times.append((stage, start, end))
 
-async def process_queue():
-    global PROCESSING
     while True:
-        if not request_queue.empty() and not PROCESSING:
-            PROCESSING = True
-            item: QueueItem = request_queue.get()
-            try:
-                item.status = "processing"
-                item.position = 0
-                active_requests[item.id] = item
-
-                # Create temporary file
-                temp_file_path = Path(ROOT + f"temp_{item.file_name}")
-                with temp_file_path.open("wb") as temp_file:
-                    temp_file.write(item.file_content)
-
-                # Process the transcription request
-                result = await process_transcription(temp_file_path, item.hotwords)
-
-                item.status = "completed"
-                item.result = result
-
-                # Cleanup
-                if temp_file_path.exists():
-                    temp_file_path.unlink()
-
-            except Exception as e:
-                item.status = "failed"
-                item.result = {"error": str(e)}
-                active_requests[item.id] = item
-            finally:
-                PROCESSING = False
-
-                # Cleanup temporary file
-                if temp_file_path.exists():
-                    temp_file_path.unlink()
-
-                # Update positions and estimated wait times for remaining queued items
-                total_wait_time = 0.0
-                for queued_item in list(active_requests.values()):
-                    if queued_item.status == "queued":
-                        queued_item.position -= 1
-                        total_wait_time += item.estimated_processing_time
-                        queued_item.estimated_wait_time = total_wait_time
-
-        await asyncio.sleep(1)
+        item: QueueItem = await request_queue.get()
+        timings = None
+        try:
+            item.status = "processing"
+            item.position = 0
+            item.estimated_wait_time = 0.0
+            worker.item = item
+            worker.started = time.monotonic()
+            started_at = datetime.now()
+            queue_wait = (started_at - item.timestamp).total_seconds()
+            metrics.QUEUE_WAIT_SECONDS.observe(queue_wait)
+            if item.trace is not None:
+                item.trace.update(
+                    device=DEVICE,
+                    batch_size=BATCH_SIZE,
+                    audio_length=item.audio_length,
+                    started_at=started_at.isoformat(),
+                    queue_wait=round(queue_wait, 3),
+                )
+            job_store.update(item.id, status="processing", started_at=started_at)
+            publish(item.id)
+            update_queue_estimates()
+
+            # Process the transcription request without blocking the event loop
+            artifacts, result_size = await loop.run_in_executor(
+                executor,
+                process_transcription,
+                worker,
+                item,
+                on_stage,
+                on_parallel_stage,
+            )
+
+            item.status = "completed"
+            finished = time.monotonic()
+            durations = item.stage_durations(finished)
+            estimator.observe(
+                DEVICE, item.audio_length, durations, item.checkpointed_stages
+            )
+            for stage, duration in durations.items():
+                metrics.STAGE_SECONDS.observe(duration, stage)
+            # The parallel stages are not part of the estimates, the wait for them
+            # already is.
+            for stage, start, end in item.parallel_stage_times:
+                metrics.STAGE_SECONDS.observe(end - start, stage)
+            if item.audio_length > 0:
+                metrics.REAL_TIME_FACTOR.observe(
+                    (finished - worker.started) / item.audio_length
+                )
+            timings = finish_trace(worker, item, finished)
+            job_store.update(
+                item.id,
+                status="completed",
+                finished_at=datetime.now(),
+                artifacts=artifacts,
+                result_size=result_size,
+                timings=timings,
+            )
+
+        except asyncio.CancelledError:
+            # The API shuts down. The spool file and the job in the store are left
+            # as they are, so the job is resumed after the restart.
+            raise
+        except Exception as e:
+            item.status = "failed"
+            timings = finish_trace(worker, item, time.monotonic())
+            job_store.update(
+                item.id,
+                status="failed",
+                finished_at=datetime.now(),
+                error=str(e),
+                timings=timings,
+            )
+
+        metrics.JOBS.inc(item.status)
+        worker.item = None
+        del active_requests[item.id]
+        if in_flight.get(item.cache_key) is item:
+            del in_flight[item.cache_key]
+        request_queue.task_done(item)
+        publish(item.id)
+
+        # Cleanup spool file
+        release_spool(item.file_path)
+
+        if item.status == "completed":
+            await evict_results()
+
+        if (
+            SLOW_JOB_RTF > 0
+            and timings is not None
+            and timings.get("real_time_factor", 0.0) > SLOW_JOB_RTF
+        ):
+            await asyncio.to_thread(log_slow_job, item, timings)
+
+        # Update positions and estimated wait times for remaining queued items
+        update_queue_estimates()
 
 
 @app.post("/transcribe")
 async def transcribe_audio(
-    audio_file: UploadFile = File(...), hotwords: list[str] = Form(default=[])
+    audio_file: UploadFile = File(...),
+    hotwords: list[str] = Form(default=[]),
+    user_id: str = Form(default=""),
 ):
-    if request_queue.qsize() >= MAX_QUEUE_SIZE:
+    # Every user has their own queue, so one user cannot fill the queue of others
+    if queue_full(user_id):
         raise HTTPException(
             status_code=503,  # Service Unavailable
             detail=queue_full_message,
@@ -162,133 +621,232 @@ async def transcribe_audio(
 
     # Generate unique ID for this request
     request_id = str(uuid.uuid4())
-    file_content = await audio_file.read()
+    started = time.monotonic()
+    part_path, spool_path = await asyncio.to_thread(
+        spool_upload, audio_file.file, audio_file.filename
+    )
+    file_path = acquire_spool(part_path, spool_path)
+    upload_time = time.monotonic() - started
+    metrics.STAGE_SECONDS.observe(upload_time, "upload")
 
-    # Create temporary file to get audio length
-    temp_file_path = Path(ROOT + f"temp_{audio_file.filename}")
-    audio_length = await get_audio_length(file_content, temp_file_path)
+    # Attach to an identical request instead of transcribing the audio again
+    key = cache_key(file_path, hotwords)
+    if RESULT_CACHE and (cached_id := cached_request(key)) is not None:
+        release_spool(file_path)
+        return queue_response(cached_id)
 
-    # Cleanup temp file
-    if temp_file_path.exists():
-        temp_file_path.unlink()
+    try:
+        started = time.monotonic()
+        audio_length = await asyncio.to_thread(get_audio_length, file_path)
+        probe_time = time.monotonic() - started
+        metrics.STAGE_SECONDS.observe(probe_time, "probe")
+    except ValueError as e:
+        release_spool(file_path)
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception:
+        release_spool(file_path)
+        raise
+
+    # An identical upload may have been queued during the probe
+    if RESULT_CACHE and (cached_id := cached_request(key)) is not None:
+        release_spool(file_path)
+        return queue_response(cached_id)
+
+    # Concurrent uploads may have filled the queue meanwhile
+    if queue_full(user_id):
+        release_spool(file_path)
+        raise HTTPException(status_code=503, detail=queue_full_message)
 
     # Create queue item
     item = QueueItem(
         id=request_id,
+        user_id=user_id,
         file_name=audio_file.filename,
-        file_content=file_content,
+        file_path=file_path,
         hotwords=hotwords,
         timestamp=datetime.now(),
         audio_length=audio_length,
+        cache_key=key,
+    )
+    if JOB_TRACE:
+        item.trace = {"upload": round(upload_time, 3), "probe": round(probe_time, 3)}
+
+    # Estimated from the stage timings of the completed jobs
+    item.estimated_processing_time = estimator.estimate(DEVICE, audio_length)
+
+    # Add to queue and tracking dict, then update position and waiting time
+    job_store.add(
+        item.id,
+        item.user_id,
+        item.file_name,
+        item.file_path,
+        item.hotwords,
+        item.timestamp,
+        item.audio_length,
+        item.estimated_processing_time,
+        item.cache_key,
     )
-
-    # Calculate waiting time based on items in queue
-    total_wait_time = 0
-    for queued_item in list(active_requests.values()):
-        if queued_item.status == "queued":
-            # Each 10 seconds of audio takes ~1 second to process
-            total_wait_time += queued_item.audio_length / 10
-
-    # Add current item's processing time
-    processing_time = audio_length / 10
-
-    item.status = "queued"
-    item.estimated_wait_time = total_wait_time
-    item.estimated_processing_time = processing_time
-
-    # Update position
-    item.position = request_queue.qsize() + (1 if PROCESSING else 0)
-
-    # Add to queue and tracking dict
-    request_queue.put(item)
     active_requests[request_id] = item
+    in_flight[item.cache_key] = item
+    request_queue.put_nowait(item)
+    update_queue_estimates()
 
-    return {
-        "request_id": request_id,
-        "position": item.position,
-        "status": item.status,
-        "estimated_wait_time": item.estimated_wait_time,
-        "estimated_processing_time": item.estimated_processing_time,
-    }
+    return queue_response(request_id)
 
 
 @app.get("/status/{request_id}")
 async def get_status(request_id: str):
-    if request_id not in active_requests:
+    response = job_status(request_id)
+    if response is None:
         raise HTTPException(status_code=404, detail="Request not found")
+    return response
 
-    item = active_requests[request_id]
-
-    # Update position if still queued
-    if item.status == "queued":
-        item.position = list(active_requests.values()).index(item)
 
-    response = {
-        "status": item.status,
-        "position": item.position,
-        "estimated_wait_time": item.estimated_wait_time,
-        "estimated_processing_time": item.estimated_processing_time,
+@app.get("/metrics")
+async def get_metrics():
+    gauges = {
+        "transcription_queue_depth": (
+            "Number of queued transcriptions.",
+            request_queue.qsize(),
+        ),
+        "transcription_jobs_running": (
+            "Number of transcriptions being processed.",
+            sum(worker.item is not None for worker in workers),
+        ),
+        "transcription_workers": ("Number of transcription workers.", len(workers)),
     }
-
-    if item.status == "completed":
-        response["result"] = item.result
-        # Clean up completed request
-        del active_requests[request_id]
-    elif item.status == "failed":
-        response["error"] = item.result["error"]
-        del active_requests[request_id]
-
-    return response
+    return Response(
+        metrics.render(gauges), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
 
 
-async def process_transcription(temp_file_path: Path, hotwords: list[str]):
-    try:
-        # Verify audio stream exists
-        if not ffmpeg.probe(temp_file_path, select_streams="a")["streams"]:
-            return {"error": "No valid audio stream found in the file"}
-
-        # Process audio file
-        output_file = Path(ROOT + f"temp_processed_{temp_file_path.name}")
-        exit_status = os.system(
-            f'ffmpeg -y -i "{temp_file_path}" -filter:v scale=320:-2 -af "lowpass=3000,highpass=200" "{output_file}"'
-        )
+@app.get("/jobs/{request_id}/events")
+async def get_events(request_id: str):
+    # Server-sent events with the status document of the request. An event is sent
+    # on every stage transition and queue position change, the stream ends once the
+    # request is completed or failed.
+    if job_status(request_id) is None:
+        raise HTTPException(status_code=404, detail="Request not found")
 
-        if exit_status == 256:
-            exit_status = os.system(
-                f'ffmpeg -y -i "{temp_file_path}" -c:v copy -af "lowpass=3000,highpass=200" "{output_file}"'
-            )
+    subscriber = asyncio.Queue()
+    subscribers[request_id].add(subscriber)
+
+    async def stream():
+        try:
+            status = job_status(request_id)
+            while True:
+                yield f"data: {json.dumps(status)}\n\n"
+                if status["status"] in ("completed", "failed"):
+                    break
+                while True:
+                    try:
+                        status = await asyncio.wait_for(
+                            subscriber.get(), EVENTS_KEEPALIVE
+                        )
+                        break
+                    except TimeoutError:
+                        yield ": keepalive\n\n"
+        finally:
+            subscribers[request_id].discard(subscriber)
+            if not subscribers[request_id]:
+                del subscribers[request_id]
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
-        if exit_status != 0:
-            output_file = temp_file_path
-
-        # Perform transcription
-        data = transcribe(
-            output_file,
-            model,
-            diarize_model,
-            DEVICE,
-            None,
-            add_language=True,
-            hotwords=hotwords,
-            batch_size=BATCH_SIZE,
-        )
 
-        # Generate SRT and viewer content
-        srt_content = create_srt(data)
-        viewer_content = create_viewer(
-            data, output_file, encode_base64=True, combine_speaker=False, root=ROOT
+@app.get("/jobs/{request_id}/{artifact}")
+async def get_artifact(
+    request_id: str,
+    artifact: Literal["transcription", "srt", "vtt", "viewer"],
+    request: Request,
+):
+    job = job_store.get(request_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Request not found")
+    if job["status"] != "completed":
+        raise HTTPException(status_code=409, detail="Request is not completed")
+
+    path = job["artifacts"].get(artifact)
+    if path is None or not path.exists():
+        raise HTTPException(status_code=410, detail="Result has expired")
+    job_store.update(request_id, last_used_at=datetime.now())
+    return artifact_response(request, path, artifact)
+
+
+def process_transcription(worker: Worker, item: QueueItem, on_stage, on_parallel_stage):
+    checkpoints = Checkpoints(checkpoint_dir(item)) if CHECKPOINTS else None
+
+    # Decode the audio once, it is shared by all stages of the transcription
+    on_stage(item, "decode")
+    audio = checkpoints.load_audio() if checkpoints is not None else None
+    if audio is None:
+        audio = decode_audio(item.file_path)
+        if checkpoints is not None:
+            checkpoints.save_audio(audio)
+
+    # Perform transcription
+    data = transcribe(
+        audio,
+        worker.backend,
+        None,
+        add_language=True,
+        hotwords=item.hotwords,
+        batch_size=BATCH_SIZE,
+        langid_batch_size=LANGID_BATCH_SIZE,
+        on_stage=lambda stage: on_stage(item, stage),
+        on_parallel_stage=lambda stage, start, end: on_parallel_stage(
+            item, stage, start, end
+        ),
+        trace=item.trace,
+        checkpoints=checkpoints,
+        parallel_diarization=DIARIZE_PARALLEL,
+    )
+    del audio
+    if checkpoints is not None:
+        if "audio" in checkpoints.loaded:
+            item.checkpointed_stages.add("decode")
+        if "turns" in checkpoints.loaded:
+            item.checkpointed_stages.update(("diarize", "diarize_wait"))
+    if item.trace is not None:
+        item.trace["segments"] = len(data)
+        item.trace["words"] = sum(len(segment.get("words", [])) for segment in data)
+        item.trace["speakers"] = len(
+            {segment["speaker"] for segment in data if "speaker" in segment}
         )
 
-        # Clean up temporary files
-        if output_file != temp_file_path:
-            output_file.unlink()
+    # Generate SRT and viewer content
+    on_stage(item, "srt")
+    srt_content = create_srt(data)
+    vtt_content = create_vtt(data)
+    on_stage(item, "viewer")
+    viewer_content = create_viewer(
+        data,
+        item.file_name,
+        encode_base64=True,
+        combine_speaker=False,
+        root=ROOT,
+        compact=VIEWER_COMPACT,
+    )
 
-        return {"transcription": data, "srt": srt_content, "viewer": viewer_content}
+    # Store the results next to each other in the output directory
+    on_stage(item, "write")
+    out_dir = Path(ROOT + f"data/out/{item.id}/")
+    out_dir.mkdir(parents=True, exist_ok=True)
+    artifacts = {name: out_dir / file_name for name, file_name in FILE_NAMES.items()}
+    write_artifact(
+        artifacts["transcription"],
+        json.dumps(data, ensure_ascii=False, default=float),
+    )
+    write_artifact(artifacts["srt"], srt_content)
+    write_artifact(artifacts["vtt"], vtt_content)
+    write_artifact(artifacts["viewer"], viewer_content)
 
-    except Exception as e:
-        if output_file.exists() and output_file != temp_file_path:
-            output_file.unlink()
-        raise e
+    result_size = sum(path.stat().st_size for path in out_dir.iterdir())
+    return artifacts, result_size
 
 
 if __name__ == "__main__":
@@ -0,0 +1,77 @@
+import gzip
+from pathlib import Path
+
+from fastapi import Request
+from fastapi.responses import FileResponse, Response
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+MEDIA_TYPES = {
+    "transcription": "application/json",
+    "srt": "application/x-subrip",
+    "vtt": "text/vtt",
+    "viewer": "text/html",
+}
+FILE_NAMES = {
+    "transcription": "transcription.json",
+    "srt": "transcription.srt",
+    "vtt": "transcription.vtt",
+    "viewer": "viewer.html",
+}
+# Preferred order of the precompressed representations
+ENCODINGS = {"br": ".br", "gzip": ".gz"}
+
+
+def write_artifact(path: Path, content: str):
+    # Store the artifact together with precompressed copies, so responses never
+    # compress on the fly and Range requests work on every representation.
+    data = content.encode("utf-8")
+    path.write_bytes(data)
+    Path(str(path) + ".gz").write_bytes(gzip.compress(data, compresslevel=6))
+    if brotli is not None:
+        Path(str(path) + ".br").write_bytes(brotli.compress(data, quality=5))
+
+
+def accepted_encodings(accept_encoding: str) -> set[str]:
+    encodings = set()
+    for part in accept_encoding.split(","):
+        name, _, params = part.partition(";")
+        key, _, value = params.partition("=")
+        if key.strip() == "q" and value.strip() in ("0", "0.0", "0.00", "0.000"):
+            continue
+        encodings.add(name.strip().lower())
+    return encodings
+
+
+def artifact_response(request: Request, path: Path, artifact: str) -> Response:
+    # Serve an artifact with content negotiation, ETag revalidation and Range
+    # support (handled by FileResponse).
+    stat = path.stat()
+    accepted = accepted_encodings(request.headers.get("accept-encoding", ""))
+    encoding = None
+    for name, suffix in ENCODINGS.items():
+        if name in accepted and Path(str(path) + suffix).exists():
+            encoding = name
+            break
+
+    suffix = f"-{encoding}" if encoding else ""
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}{suffix}"'
+    headers = {
+        "ETag": etag,
+        "Vary": "Accept-Encoding",
+        "Cache-Control": "private, no-cache",
+    }
+    if_none_match = request.headers.get("if-none-match", "")
+    if (
+        etag in [tag.strip() for tag in if_none_match.split(",")]
+        or if_none_match == "*"
+    ):
+        return Response(status_code=304, headers=headers)
+
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+        path = Path(str(path) + ENCODINGS[encoding])
+    return FileResponse(path, media_type=MEDIA_TYPES[artifact], headers=headers)
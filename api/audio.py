@@ -0,0 +1,60 @@
+import subprocess
+
+import ffmpeg
+import numpy as np
+
+SAMPLE_RATE = 16000
+AUDIO_FILTERS = "lowpass=3000,highpass=200"
+
+
+def get_audio_length(file_path) -> float:
+    # Duration of the first audio stream, falling back to the container duration.
+    # Files that are no valid media raise a ValueError.
+    try:
+        probe = ffmpeg.probe(str(file_path), select_streams="a")
+    except ffmpeg.Error as e:
+        raise ValueError("The file is not a valid audio or video file") from e
+    if not probe["streams"]:
+        raise ValueError("No valid audio stream found in the file")
+    duration = probe["streams"][0].get("duration", probe["format"].get("duration"))
+    try:
+        return float(duration)
+    except (TypeError, ValueError) as e:
+        raise ValueError("The duration of the audio is unknown") from e
+
+
+def decode_audio(file_path, sample_rate=SAMPLE_RATE):
+    # Decode the first audio stream of an audio or video file into mono float32 PCM
+    # in a single ffmpeg pass. The video stream is never decoded. The result is
+    # shared by all stages of the transcription.
+    cmd = [
+        "ffmpeg",
+        "-nostdin",
+        "-threads",
+        "0",
+        "-i",
+        str(file_path),
+        "-map",
+        "0:a:0",
+        "-vn",
+        "-sn",
+        "-dn",
+        "-af",
+        AUDIO_FILTERS,
+        "-ac",
+        "1",
+        "-ar",
+        str(sample_rate),
+        "-f",
+        "f32le",
+        "-acodec",
+        "pcm_f32le",
+        "-",
+    ]
+    try:
+        out = subprocess.run(cmd, capture_output=True, check=True).stdout
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"Failed to load audio: {e.stderr.decode()}") from e
+
+    # Copy into a writable array, torch refuses to share read-only buffers.
+    return np.frombuffer(out, np.float32).copy()
@@ -0,0 +1,136 @@
+from abc import ABC, abstractmethod
+import random
+import time
+
+from audio import SAMPLE_RATE
+
+STUB_WORDS = (
+    "und der die das ist nicht ein eine wir sie es mit auf für von Gemeinderat "
+    "Kanton Zürich Sitzung Antrag Budget Abstimmung Vorlage Kommission Bericht"
+).split()
+
+
+class InferenceBackend(ABC):
+    # The models used by transcription.transcribe. Every worker creates its own
+    # backend, so an instance is only used by one job at a time. audio is mono
+    # float32 PCM at SAMPLE_RATE, segments are whisperx-style dicts.
+
+    def preload(self, languages: list[str]):
+        # Load the models needed for these languages in advance.
+        pass
+
+    @abstractmethod
+    def transcribe(
+        self, audio, hotwords: list[str], batch_size: int, checkpoints=None
+    ) -> dict:
+        # {"segments": [{"start", "end", "text"}, ...], "language": code}
+        # Intermediate results that only depend on the audio may be stored in
+        # checkpoints (checkpoints.Checkpoints) to be reused by later runs.
+        ...
+
+    @abstractmethod
+    def align(self, segments: list[dict], language: str, audio) -> dict:
+        # {"segments": [...]} with word level timestamps in segment["words"]
+        ...
+
+    @abstractmethod
+    def detect_languages(
+        self, audio, segments: list[dict], batch_size: int
+    ) -> list[tuple[str, float]]:
+        # (language code, probability) of every segment
+        ...
+
+    @abstractmethod
+    def diarize(
+        self, audio, num_speakers: int | None
+    ) -> list[tuple[float, float, str]]:
+        # Speaker turns as (start, end, speaker)
+        ...
+
+
+class StubBackend(InferenceBackend):
+    # Deterministic backend without any model, to run the queue, API and rendering
+    # on any machine. The result only depends on the length of the audio: a segment
+    # every few seconds and speakers taking turns. The transcription sleeps for
+    # real_time_factor seconds per second of audio to simulate the model.
+    def __init__(self, real_time_factor: float = 0.0):
+        self.real_time_factor = real_time_factor
+
+    def transcribe(self, audio, hotwords, batch_size, checkpoints=None):
+        duration = audio.shape[0] / SAMPLE_RATE
+        time.sleep(duration * self.real_time_factor)
+
+        rng = random.Random(audio.shape[0])
+        # The frontend sends [""] for an empty vocabulary
+        words = [word for word in hotwords if word.strip()] + list(STUB_WORDS)
+        segments = []
+        start = 0.0
+        while start + 1.0 <= duration:
+            end = min(start + rng.uniform(2.0, 8.0), duration)
+            n_words = max(int((end - start) * 2.5), 1)
+            text = " " + " ".join(rng.choice(words) for _ in range(n_words))
+            segments.append(
+                {"start": round(start, 3), "end": round(end, 3), "text": text}
+            )
+            start = end + rng.uniform(0.0, 1.0)
+        return {"segments": segments, "language": "de"}
+
+    def align(self, segments, language, audio):
+        aligned = []
+        for segment in segments:
+            words = segment["text"].split()
+            if not words:
+                aligned.append({**segment, "words": []})
+                continue
+            step = (segment["end"] - segment["start"]) / len(words)
+            aligned.append(
+                {
+                    **segment,
+                    "words": [
+                        {
+                            "word": word,
+                            "start": round(segment["start"] + i * step, 3),
+                            "end": round(segment["start"] + (i + 0.8) * step, 3),
+                            "score": 0.9,
+                        }
+                        for i, word in enumerate(words)
+                    ],
+                }
+            )
+        return {"segments": aligned}
+
+    def detect_languages(self, audio, segments, batch_size):
+        return [("de", 1.0) for _ in segments]
+
+    def diarize(self, audio, num_speakers):
+        duration = audio.shape[0] / SAMPLE_RATE
+        rng = random.Random(audio.shape[0] + 1)
+        speakers = [f"SPEAKER_{i:02d}" for i in range(num_speakers or 2)]
+        turns = []
+        start = 0.0
+        while start < duration:
+            end = min(start + rng.uniform(5.0, 30.0), duration)
+            turns.append((start, end, speakers[len(turns) % len(speakers)]))
+            start = end
+        return turns
+
+
+def create_backend(
+    name: str,
+    device: str,
+    hf_auth_token: str = None,
+    align_cache_size: int = 3,
+    asr_threads: int = 4,
+    torch_threads: int = 0,
+    stub_real_time_factor: float = 0.0,
+) -> InferenceBackend:
+    if name == "stub":
+        return StubBackend(stub_real_time_factor)
+    if name == "whisperx":
+        # Imported here, so selecting the stub backend loads no models
+        from whisperx_backend import WhisperXBackend
+
+        return WhisperXBackend(
+            device, hf_auth_token, align_cache_size, asr_threads, torch_threads
+        )
+    raise ValueError(f"Unknown inference backend: {name}")
@@ -0,0 +1,188 @@
+# Benchmark of the post-processing that runs on every job: speaker assignment,
+# data leak cleanup, SRT and viewer rendering. The input is a synthetic whisperx
+# result, so the benchmark runs on a CPU-only machine without any model.
+#
+#   uv run benchmark.py                      # compare against benchmark_baseline.json
+#   uv run benchmark.py --save-baseline      # store the current results as baseline
+#   uv run benchmark.py --words 1000 --speakers 2 --repeat 5
+#
+# Exits with status 1 if a function got slower or uses more memory than the
+# baseline allows (see --tolerance).
+import argparse
+import copy
+import json
+import os
+from pathlib import Path
+import random
+import sys
+import time
+import tracemalloc
+
+os.environ.setdefault("ADDITIONAL_SPEAKERS", "4")
+
+from const import data_leaks
+from speakers import assign_speakers
+from srt import create_srt
+from transcription import remove_data_leaks
+from viewer import create_viewer
+
+ROOT = str(Path(__file__).parent) + "/"
+BASELINE = Path(__file__).parent / "benchmark_baseline.json"
+VOCABULARY = (
+    "und der die das ist nicht ein eine wir sie es mit auf für von Gemeinderat "
+    "Kanton Zürich Sitzung Antrag Budget Abstimmung Vorlage Kommission Bericht "
+    "also genau heute morgen wichtig natürlich Straße Verkehr Schule Gesundheit"
+).split()
+
+
+def generate_transcript(n_words: int, n_speakers: int, seed: int = 0):
+    # A whisperx-style result with n_words words in segments of 5 to 30 words, and
+    # diarization turns of n_speakers speakers alternating every 2 to 20 seconds.
+    rng = random.Random(seed)
+    speakers = [f"SPEAKER_{i:02d}" for i in range(n_speakers)]
+    leaks = data_leaks["de"]
+
+    segments = []
+    t = 0.0
+    remaining = n_words
+    while remaining > 0:
+        words = []
+        for _ in range(min(rng.randint(5, 30), remaining)):
+            start = t + rng.uniform(0.0, 0.2)
+            end = start + rng.uniform(0.1, 0.6)
+            words.append(
+                {
+                    "word": rng.choice(VOCABULARY),
+                    "start": round(start, 3),
+                    "end": round(end, 3),
+                    "score": round(rng.uniform(0.5, 1.0), 3),
+                }
+            )
+            t = end
+        remaining -= len(words)
+        text = " " + " ".join(word["word"] for word in words)
+        if rng.random() < 0.02:
+            text += rng.choice(leaks)
+        segments.append(
+            {
+                "start": words[0]["start"],
+                "end": words[-1]["end"],
+                "text": text,
+                "words": words,
+                "language": "de",
+            }
+        )
+        t += rng.uniform(0.0, 1.5)
+
+    turns = []
+    start = 0.0
+    while start < t:
+        end = start + rng.uniform(2.0, 20.0)
+        turns.append((start, end, rng.choice(speakers)))
+        start = end
+    return segments, turns
+
+
+def measure(function, make_args, repeat: int) -> dict:
+    # Best wall time of repeat runs and the peak memory of a separate run, since
+    # tracemalloc slows down the execution. The arguments are created outside of
+    # the measurement, as the functions may modify them.
+    seconds = []
+    for _ in range(repeat):
+        args = make_args()
+        started = time.perf_counter()
+        function(*args)
+        seconds.append(time.perf_counter() - started)
+
+    args = make_args()
+    tracemalloc.start()
+    function(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": min(seconds), "peak_memory": peak}
+
+
+def run(n_words: int, n_speakers: int, repeat: int) -> dict:
+    segments, turns = generate_transcript(n_words, n_speakers)
+    assigned = assign_speakers(turns, copy.deepcopy(segments))
+
+    benchmarks = {
+        "assign_speakers": (
+            assign_speakers,
+            lambda: (turns, copy.deepcopy(segments)),
+        ),
+        "remove_data_leaks": (
+            remove_data_leaks,
+            lambda: (copy.deepcopy(assigned), "de"),
+        ),
+        "create_srt": (create_srt, lambda: (copy.deepcopy(assigned),)),
+        "create_viewer": (
+            create_viewer,
+            lambda: (copy.deepcopy(assigned), "audio.mp4", True, False, ROOT),
+        ),
+        "create_viewer_compact": (
+            create_viewer,
+            lambda: (copy.deepcopy(assigned), "audio.mp4", True, False, ROOT, True),
+        ),
+    }
+    return {
+        f"{name}/{n_words}w/{n_speakers}s": measure(function, make_args, repeat)
+        for name, (function, make_args) in benchmarks.items()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the post-processing of a transcription."
+    )
+    parser.add_argument("--words", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--speakers", type=int, nargs="+", default=[2, 20])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", type=Path, default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="allowed relative increase of time and memory over the baseline",
+    )
+    args = parser.parse_args()
+
+    results = {}
+    for n_words in args.words:
+        for n_speakers in args.speakers:
+            results.update(run(n_words, n_speakers, args.repeat))
+
+    baseline = {}
+    if args.baseline.exists() and not args.save_baseline:
+        baseline = json.loads(args.baseline.read_text())
+
+    regressions = []
+    print(f"{'benchmark':<40} {'seconds':>10} {'peak MiB':>10}  baseline")
+    for key, result in results.items():
+        line = (
+            f"{key:<40} {result['seconds']:>10.4f} "
+            f"{result['peak_memory'] / 2**20:>10.2f}"
+        )
+        if key in baseline:
+            reference = baseline[key]
+            line += (
+                f"  {reference['seconds']:.4f}s "
+                f"{reference['peak_memory'] / 2**20:.2f}MiB"
+            )
+            for metric in ("seconds", "peak_memory"):
+                if result[metric] > reference[metric] * (1 + args.tolerance):
+                    regressions.append(f"{key} {metric}")
+                    line += f"  REGRESSION ({metric})"
+        print(line)
+
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(results, indent=2) + "\n")
+        print(f"Saved baseline to {args.baseline}")
+    elif regressions:
+        print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+import json
+import os
+from pathlib import Path
+import shutil
+import time
+import uuid
+
+import numpy as np
+
+
+class Checkpoints:
+    # Intermediate results that only depend on the audio: the decoded PCM, the voice
+    # activity and the speaker turns. They are stored per audio hash, so a rerun of
+    # the same file with other hotwords, or a retry after a failure in a later stage,
+    # only repeats the transcription, alignment and speaker assignment.
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # Names of the checkpoints that were loaded instead of computed
+        self.loaded: set[str] = set()
+        # The modification time of the directory is the last use for the eviction
+        os.utime(self.directory)
+
+    def path(self, name: str) -> Path:
+        return self.directory / name
+
+    def write(self, name: str, save):
+        # save(file) writes the checkpoint, it only becomes visible once complete.
+        part_path = self.path(f"{uuid.uuid4()}.part")
+        with part_path.open("wb") as part_file:
+            save(part_file)
+        part_path.replace(self.path(name))
+
+    def load_audio(self) -> np.ndarray | None:
+        if not self.path("audio.npy").exists():
+            return None
+        audio = np.load(self.path("audio.npy"))
+        self.loaded.add("audio")
+        return audio
+
+    def save_audio(self, audio: np.ndarray):
+        self.write("audio.npy", lambda file: np.save(file, audio))
+
+    def load_turns(self, num_speakers) -> list[tuple[float, float, str]] | None:
+        path = self.path(f"diarization_{num_speakers or 'auto'}.json")
+        if not path.exists():
+            return None
+        turns = [tuple(turn) for turn in json.loads(path.read_text())]
+        self.loaded.add("turns")
+        return turns
+
+    def save_turns(self, num_speakers, turns: list[tuple[float, float, str]]):
+        self.write(
+            f"diarization_{num_speakers or 'auto'}.json",
+            lambda file: file.write(json.dumps(turns).encode()),
+        )
+
+
+def evict_checkpoints(
+    cache_dir: Path, max_size: float, max_age: float, in_use: set[Path]
+):
+    # Delete the checkpoints not used for max_age seconds, and the least recently
+    # used ones while all checkpoints exceed max_size bytes. Checkpoints of running
+    # or queued jobs (in_use) are kept.
+    if not cache_dir.exists():
+        return
+    directories = []
+    for directory in cache_dir.glob("*/*/"):
+        try:
+            size = sum(path.stat().st_size for path in directory.iterdir())
+            directories.append((directory.stat().st_mtime, size, directory))
+        except OSError:  # changed by a running job meanwhile
+            continue
+    directories.sort()
+
+    total_size = sum(size for _, size, _ in directories)
+    cutoff = time.time() - max_age
+    for last_used, size, directory in directories:
+        if last_used >= cutoff and total_size <= max_size:
+            break
+        if directory in in_use:
+            continue
+        shutil.rmtree(directory, ignore_errors=True)
+        total_size -= size
@@ -0,0 +1,77 @@
+from dataclasses import dataclass
+
+# Weight of older observations after every new one, so the estimates follow
+# changes of the hardware or the models.
+DECAY = 0.95
+# Heuristic used until the first job on a device has finished.
+DEFAULT_SPEED = 10.0  # seconds of audio per second of processing
+
+
+@dataclass
+class StageStats:
+    # Exponentially weighted sums for a least squares fit of
+    # processing seconds = intercept + slope * audio seconds.
+    n: float = 0.0
+    sx: float = 0.0
+    sy: float = 0.0
+    sxx: float = 0.0
+    sxy: float = 0.0
+
+    def add(self, x: float, y: float):
+        self.n = self.n * DECAY + 1.0
+        self.sx = self.sx * DECAY + x
+        self.sy = self.sy * DECAY + y
+        self.sxx = self.sxx * DECAY + x * x
+        self.sxy = self.sxy * DECAY + x * y
+
+    def predict(self, x: float) -> float:
+        denominator = self.n * self.sxx - self.sx * self.sx
+        if self.n < 2 or denominator <= 1e-9 * self.n * self.sxx:
+            # Not enough distinct audio lengths for a line, assume proportionality.
+            slope = self.sy / self.sx if self.sx > 0 else 0.0
+            return max(slope * x, 0.0)
+
+        slope = max((self.n * self.sxy - self.sx * self.sy) / denominator, 0.0)
+        intercept = max((self.sy - slope * self.sx) / self.n, 0.0)
+        return intercept + slope * x
+
+
+class ProcessingTimeEstimator:
+    # Estimates the processing time of a job from the stage timings of completed
+    # jobs. Every stage (decode, asr, align, ...) has its own linear model per device.
+    def __init__(self, job_store):
+        self.job_store = job_store
+        self.stats: dict[tuple[str, str], StageStats] = {}
+        for row in job_store.stage_stats():
+            self.stats[(row["device"], row["stage"])] = StageStats(
+                n=row["n"], sx=row["sx"], sy=row["sy"], sxx=row["sxx"], sxy=row["sxy"]
+            )
+
+    def estimate(self, device: str, audio_length: float) -> float:
+        stages = [stats for (d, _), stats in self.stats.items() if d == device]
+        if not stages:
+            return audio_length / DEFAULT_SPEED
+        return sum(stats.predict(audio_length) for stats in stages)
+
+    def observe(
+        self,
+        device: str,
+        audio_length: float,
+        durations: dict[str, float],
+        skipped: set[str] = frozenset(),
+    ):
+        # Every completed job passes through all stages, forget stages that no
+        # longer exist so they are not part of the estimates anymore. The skipped
+        # stages ran, but their duration is not representative (e.g. their result
+        # was loaded from a checkpoint), they keep their stats unchanged.
+        for d, stage in list(self.stats):
+            if d == device and stage not in durations:
+                del self.stats[(d, stage)]
+                self.job_store.delete_stage_stats(device, stage)
+
+        for stage, duration in durations.items():
+            if stage in skipped:
+                continue
+            stats = self.stats.setdefault((device, stage), StageStats())
+            stats.add(audio_length, duration)
+            self.job_store.save_stage_stats(device, stage, stats)
@@ -0,0 +1,176 @@
+import json
+import sqlite3
+from datetime import datetime
+from pathlib import Path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL DEFAULT '',
+    file_name TEXT NOT NULL,
+    file_path TEXT NOT NULL,
+    hotwords TEXT NOT NULL,
+    status TEXT NOT NULL,
+    stage TEXT,
+    audio_length REAL NOT NULL DEFAULT 0,
+    estimated_processing_time REAL NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL,
+    started_at TEXT,
+    finished_at TEXT,
+    artifacts TEXT,
+    error TEXT,
+    timings TEXT,
+    cache_key TEXT,
+    last_used_at TEXT,
+    result_size INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished_at);
+CREATE TABLE IF NOT EXISTS stage_stats (
+    device TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    n REAL NOT NULL,
+    sx REAL NOT NULL,
+    sy REAL NOT NULL,
+    sxx REAL NOT NULL,
+    sxy REAL NOT NULL,
+    PRIMARY KEY (device, stage)
+);
+"""
+# Columns that were added to the jobs table later, added to older databases on startup
+COLUMNS = {
+    "user_id": "TEXT NOT NULL DEFAULT ''",
+    "timings": "TEXT",
+    "cache_key": "TEXT",
+    "last_used_at": "TEXT",
+    "result_size": "INTEGER NOT NULL DEFAULT 0",
+}
+
+
+class JobStore:
+    # Durable record of all transcription jobs. The store is only used from the
+    # event loop thread; every statement is committed immediately (autocommit).
+    def __init__(self, db_path: Path):
+        self.connection = sqlite3.connect(db_path, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        existing = {
+            row["name"] for row in self.connection.execute("PRAGMA table_info(jobs)")
+        }
+        for column, definition in COLUMNS.items():
+            if column not in existing:
+                self.connection.execute(
+                    f"ALTER TABLE jobs ADD COLUMN {column} {definition}"
+                )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_cache_key ON jobs (cache_key, status)"
+        )
+
+    def add(
+        self,
+        id: str,
+        user_id: str,
+        file_name: str,
+        file_path: Path,
+        hotwords: list[str],
+        created_at: datetime,
+        audio_length: float,
+        estimated_processing_time: float,
+        cache_key: str,
+    ):
+        self.connection.execute(
+            "INSERT INTO jobs (id, user_id, file_name, file_path, hotwords, status, "
+            "audio_length, estimated_processing_time, created_at, cache_key) "
+            "VALUES (?, ?, ?, ?, ?, 'queued', ?, ?, ?, ?)",
+            (
+                id,
+                user_id,
+                file_name,
+                str(file_path),
+                json.dumps(hotwords),
+                audio_length,
+                estimated_processing_time,
+                created_at.isoformat(),
+                cache_key,
+            ),
+        )
+
+    def update(self, id: str, **fields):
+        for key in ("started_at", "finished_at", "last_used_at"):
+            if isinstance(fields.get(key), datetime):
+                fields[key] = fields[key].isoformat()
+        if "artifacts" in fields:
+            fields["artifacts"] = json.dumps(
+                {name: str(path) for name, path in fields["artifacts"].items()}
+            )
+        if "timings" in fields:
+            fields["timings"] = json.dumps(fields["timings"])
+        columns = ", ".join(f"{key} = ?" for key in fields)
+        self.connection.execute(
+            f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), id)
+        )
+
+    def get(self, id: str) -> dict | None:
+        row = self.connection.execute(
+            "SELECT * FROM jobs WHERE id = ?", (id,)
+        ).fetchone()
+        return self._to_dict(row) if row is not None else None
+
+    def unfinished(self) -> list[dict]:
+        # Jobs that were queued or running when the API stopped, oldest first.
+        rows = self.connection.execute(
+            "SELECT * FROM jobs WHERE status IN ('queued', 'processing') "
+            "ORDER BY created_at"
+        ).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def cached(self, cache_key: str) -> dict | None:
+        # Latest completed job with this cache key whose results still exist.
+        row = self.connection.execute(
+            "SELECT * FROM jobs WHERE cache_key = ? AND status = 'completed' "
+            "AND artifacts != '{}' ORDER BY finished_at DESC LIMIT 1",
+            (cache_key,),
+        ).fetchone()
+        return self._to_dict(row) if row is not None else None
+
+    def results(self) -> list[dict]:
+        # Jobs that still have result artifacts, least recently used first.
+        rows = self.connection.execute(
+            "SELECT * FROM jobs WHERE artifacts != '{}' "
+            "ORDER BY COALESCE(last_used_at, finished_at)"
+        ).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def stage_stats(self) -> list[dict]:
+        rows = self.connection.execute("SELECT * FROM stage_stats").fetchall()
+        return [dict(row) for row in rows]
+
+    def save_stage_stats(self, device: str, stage: str, stats):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO stage_stats (device, stage, n, sx, sy, sxx, sxy) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (device, stage, stats.n, stats.sx, stats.sy, stats.sxx, stats.sxy),
+        )
+
+    def delete_stage_stats(self, device: str, stage: str):
+        self.connection.execute(
+            "DELETE FROM stage_stats WHERE device = ? AND stage = ?", (device, stage)
+        )
+
+    def close(self):
+        self.connection.close()
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row) -> dict:
+        job = dict(row)
+        job["file_path"] = Path(job["file_path"])
+        job["hotwords"] = json.loads(job["hotwords"])
+        job["created_at"] = datetime.fromisoformat(job["created_at"])
+        job["artifacts"] = {
+            name: Path(path)
+            for name, path in json.loads(job["artifacts"] or "{}").items()
+        }
+        job["timings"] = json.loads(job["timings"] or "null")
+        return job
@@ -0,0 +1,110 @@
+import hashlib
+from pathlib import Path
+import re
+import threading
+
+from const import data_leaks
+
+
+def compile_phrases(phrases) -> re.Pattern | None:
+    # One regex for all phrases, built from a prefix tree: the alternatives of a
+    # position only differ in their next character, so the cost of a search barely
+    # grows with the number of phrases. Of phrases starting at the same position the
+    # longest one matches.
+    trie = {}
+    for phrase in phrases:
+        if not phrase:
+            continue
+        node = trie
+        for char in phrase:
+            node = node.setdefault(char, {})
+        node[""] = {}
+    if not trie:
+        return None
+    return re.compile(_trie_pattern(trie))
+
+
+def _trie_pattern(node: dict) -> str:
+    branches = [
+        re.escape(char) + _trie_pattern(child)
+        for char, child in sorted(node.items())
+        if char
+    ]
+    if not branches:
+        return ""
+    pattern = branches[0] if len(branches) == 1 else f"(?:{'|'.join(branches)})"
+    if "" in node:
+        pattern = f"(?:{pattern})?"
+    return pattern
+
+
+class LeakPatterns:
+    # Compiled data leak phrases per language: the built-in table of const.py plus
+    # the phrases in <directory>/<language>.txt, one per line (leading spaces are
+    # kept, empty lines and lines starting with # are ignored). The files are read
+    # again when they change, so phrases can be added without a restart.
+    def __init__(self, builtin: dict[str, list[str]], directory: Path = None):
+        self.builtin = builtin
+        self.directory = directory
+        self.signature = None
+        self.patterns = {}
+        self.digest = None
+        self.lock = threading.Lock()
+
+    def get(self, language: str) -> re.Pattern | None:
+        with self.lock:
+            self._refresh()
+            return self.patterns.get(language)
+
+    def version(self) -> str:
+        # Hash of the current phrases of all languages, e.g. for cache keys of
+        # results that were cleaned with them.
+        with self.lock:
+            self._refresh()
+            return self.digest
+
+    def _refresh(self):
+        signature = self._signature()
+        if signature != self.signature:
+            self.patterns = self._compile()
+            phrases = sorted(
+                (language, pattern.pattern)
+                for language, pattern in self.patterns.items()
+            )
+            self.digest = hashlib.sha256(repr(phrases).encode()).hexdigest()
+            self.signature = signature
+
+    def _files(self) -> list[Path]:
+        if self.directory is None or not self.directory.is_dir():
+            return []
+        return sorted(self.directory.glob("*.txt"))
+
+    def _signature(self):
+        signature = []
+        for path in self._files():
+            try:
+                stat = path.stat()
+            except OSError:  # deleted meanwhile
+                continue
+            signature.append((path.name, stat.st_mtime_ns, stat.st_size))
+        return tuple(signature)
+
+    def _compile(self) -> dict[str, re.Pattern]:
+        phrases = {language: list(lines) for language, lines in self.builtin.items()}
+        for path in self._files():
+            try:
+                lines = path.read_text(encoding="utf-8").splitlines()
+            except OSError:
+                continue
+            phrases.setdefault(path.stem, []).extend(
+                line for line in lines if line.strip() and not line.startswith("#")
+            )
+        patterns = {}
+        for language, lines in phrases.items():
+            pattern = compile_phrases(lines)
+            if pattern is not None:
+                patterns[language] = pattern
+        return patterns
+
+
+data_leak_patterns = LeakPatterns(data_leaks)
@@ -0,0 +1,261 @@
+# Load test of the API that behaves like the frontend: every user uploads a batch
+# of files with hotwords at once, polls /status until each job is finished and
+# downloads the results. By default an API with the stub backend is started on a
+# free port, so the test runs the real queue and scheduling without any model.
+# The uploads of a duration are identical, so an API started with --url should
+# run with RESULT_CACHE=False and CHECKPOINTS=False.
+#
+#   uv run loadtest.py --users 10 --files 5 --durations 60 300 1800
+#   uv run loadtest.py --url http://localhost:8000 --users 3
+#
+# Reports p50/p99 latencies of /transcribe, /status and the result downloads,
+# rejected uploads (queue full) and the completed jobs per hour.
+import argparse
+import asyncio
+from dataclasses import dataclass, field
+import json
+import os
+from pathlib import Path
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+
+import aiohttp
+
+API_DIR = Path(__file__).parent
+HOTWORDS = ["Gemeinderat", "Kantonsrat", "Stadtpräsidentin"]
+
+
+@dataclass
+class Results:
+    latencies: dict[str, list[float]] = field(default_factory=dict)
+    turnaround: list[float] = field(default_factory=list)
+    completed: int = 0
+    failed: int = 0
+    rejected: int = 0
+    errors: int = 0
+
+    def record(self, endpoint: str, seconds: float):
+        self.latencies.setdefault(endpoint, []).append(seconds)
+
+
+def percentile(values: list[float], p: float) -> float:
+    # Nearest-rank percentile
+    ordered = sorted(values)
+    return ordered[max(int(len(ordered) * p / 100 + 0.5) - 1, 0)]
+
+
+def create_wav(path: Path, duration: float, sample_rate: int):
+    # Low noise instead of silence, so the file is not trivially compressible.
+    rng = random.Random(int(duration))
+    noise = bytes(rng.getrandbits(8) & 0x0F for _ in range(sample_rate * 2))
+    with wave.open(str(path), "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        for _ in range(int(duration)):
+            wav.writeframes(noise)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_api(root: Path, port: int, args) -> subprocess.Popen:
+    # The viewer needs the files in data/, everything else is created by the API.
+    shutil.copytree(API_DIR / "data", root / "data", dirs_exist_ok=True)
+    env = {
+        **os.environ,
+        "BACKEND": "stub",
+        "STUB_REAL_TIME_FACTOR": str(args.real_time_factor),
+        "ROOT": f"{root}/",
+        "DEVICE": "cpu",
+        "BATCH_SIZE": "4",
+        "ADDITIONAL_SPEAKERS": "4",
+        "MAX_QUEUE_SIZE": str(args.max_queue_size),
+        "MAX_TOTAL_QUEUE_SIZE": str(args.users * args.max_queue_size),
+        "WORKERS": str(args.workers),
+        # All uploads of a duration are identical, they would be served from the
+        # result cache and the checkpoints instead of being processed.
+        "RESULT_CACHE": "False",
+        "CHECKPOINTS": "False",
+    }
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api:app", "--port", str(port)],
+        cwd=API_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+async def wait_for_api(session: aiohttp.ClientSession, url: str, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with session.get(f"{url}/metrics") as response:
+                if response.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.5)
+    raise RuntimeError(f"API at {url} did not start within {timeout} seconds")
+
+
+async def timed(results: Results, endpoint: str, request):
+    started = time.monotonic()
+    async with request as response:
+        body = await response.read()
+        results.record(endpoint, time.monotonic() - started)
+        return response.status, body
+
+
+async def run_job(session, url, user_id, file_path: Path, args, results: Results):
+    data = aiohttp.FormData()
+    data.add_field("audio_file", file_path.read_bytes(), filename=file_path.name)
+    data.add_field("user_id", user_id)
+    for word in HOTWORDS:
+        data.add_field("hotwords", word)
+
+    started = time.monotonic()
+    status, body = await timed(
+        results, "transcribe", session.post(f"{url}/transcribe", data=data)
+    )
+    if status == 503:
+        results.rejected += 1
+        return
+    if status != 200:
+        results.errors += 1
+        return
+    request_id = json.loads(body)["request_id"]
+
+    while True:
+        await asyncio.sleep(args.poll_interval)
+        status, body = await timed(
+            results, "status", session.get(f"{url}/status/{request_id}")
+        )
+        if status != 200:
+            results.errors += 1
+            return
+        job = json.loads(body)
+        if job["status"] == "failed":
+            results.failed += 1
+            return
+        if job["status"] == "completed":
+            break
+
+    for artifact in ("transcription", "srt", "viewer"):
+        await timed(
+            results, "artifact", session.get(f"{url}/jobs/{request_id}/{artifact}")
+        )
+    results.turnaround.append(time.monotonic() - started)
+    results.completed += 1
+
+
+async def run_user(session, url, user, files: list[Path], args, results: Results):
+    # Like the frontend, all files of a batch are uploaded at the same time.
+    rng = random.Random(user)
+    for _ in range(args.rounds):
+        batch = rng.choices(files, weights=args.weights, k=args.files)
+        await asyncio.gather(
+            *(run_job(session, url, f"user-{user}", f, args, results) for f in batch)
+        )
+
+
+def report(results: Results, elapsed: float, args):
+    print(
+        f"{args.users} users, {args.files} files per batch, {args.rounds} round(s), "
+        f"{elapsed:.1f} s"
+    )
+    print(f"{'endpoint':<12} {'requests':>9} {'p50 ms':>9} {'p99 ms':>9}")
+    for endpoint, values in results.latencies.items():
+        print(
+            f"{endpoint:<12} {len(values):>9} {percentile(values, 50) * 1000:>9.1f} "
+            f"{percentile(values, 99) * 1000:>9.1f}"
+        )
+    print(
+        f"completed {results.completed}, failed {results.failed}, "
+        f"rejected (queue full) {results.rejected}, errors {results.errors}"
+    )
+    if results.turnaround:
+        print(
+            f"turnaround p50 {percentile(results.turnaround, 50):.1f} s, "
+            f"p99 {percentile(results.turnaround, 99):.1f} s"
+        )
+    print(f"throughput {results.completed / elapsed * 3600:.0f} jobs/hour")
+
+
+async def main(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        files = []
+        for duration in args.durations:
+            path = tmp / f"audio_{duration:g}s.wav"
+            create_wav(path, duration, args.sample_rate)
+            files.append(path)
+
+        api = None
+        url = args.url
+        if url is None:
+            port = free_port()
+            url = f"http://127.0.0.1:{port}"
+            (tmp / "root").mkdir()
+            api = start_api(tmp / "root", port, args)
+
+        results = Results()
+        timeout = aiohttp.ClientTimeout(total=None)
+        try:
+            async with aiohttp.ClientSession(timeout=timeout) as session:
+                await wait_for_api(session, url, args.startup_timeout)
+                started = time.monotonic()
+                await asyncio.gather(
+                    *(
+                        run_user(session, url, user, files, args, results)
+                        for user in range(args.users)
+                    )
+                )
+                report(results, time.monotonic() - started, args)
+        finally:
+            if api is not None:
+                api.terminate()
+                api.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test of the API.")
+    parser.add_argument("--url", help="API to test, by default a stub API is started")
+    parser.add_argument("--users", type=int, default=5)
+    parser.add_argument("--files", type=int, default=5, help="files per batch")
+    parser.add_argument("--rounds", type=int, default=1, help="batches per user")
+    parser.add_argument(
+        "--durations",
+        type=float,
+        nargs="+",
+        default=[30, 120, 600],
+        help="audio lengths in seconds the uploads are drawn from",
+    )
+    parser.add_argument(
+        "--weights", type=float, nargs="+", help="relative frequency of the durations"
+    )
+    parser.add_argument("--sample-rate", type=int, default=8000)
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--max-queue-size", type=int, default=4)
+    parser.add_argument(
+        "--real-time-factor",
+        type=float,
+        default=0.01,
+        help="seconds the stub backend spends per second of audio",
+    )
+    parser.add_argument("--startup-timeout", type=float, default=60.0)
+    args = parser.parse_args()
+    if args.weights is not None and len(args.weights) != len(args.durations):
+        parser.error("--weights needs one weight per duration")
+    asyncio.run(main(args))
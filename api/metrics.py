@@ -0,0 +1,134 @@
+import math
+import os
+
+# Metrics in the Prometheus text exposition format. All metrics are updated and
+# rendered on the event loop thread, so they need no locking.
+
+DURATION_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+RTF_BUCKETS = (0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+
+
+def format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: tuple, label: str = None):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.label = label
+        # label value -> (counts per bucket and +Inf, sum)
+        self.values: dict[str, tuple[list[int], float]] = {}
+
+    def observe(self, value: float, label_value: str = ""):
+        counts, total = self.values.get(label_value, ([0] * (len(self.buckets) + 1), 0))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+        self.values[label_value] = (counts, total + value)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_value, (counts, total) in self.values.items():
+            labels = {self.label: label_value} if self.label else {}
+            cumulative = 0
+            for bound, count in zip((*self.buckets, math.inf), counts):
+                cumulative += count
+                bucket_labels = format_labels({**labels, "le": format_value(bound)})
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(
+                f"{self.name}_sum{format_labels(labels)} {format_value(total)}"
+            )
+            lines.append(f"{self.name}_count{format_labels(labels)} {cumulative}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help: str, label: str = None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values: dict[str, float] = {}
+
+    def inc(self, label_value: str = "", amount: float = 1):
+        self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for label_value, value in self.values.items():
+            labels = format_labels({self.label: label_value} if self.label else {})
+            lines.append(f"{self.name}{labels} {format_value(value)}")
+        return lines
+
+
+STAGE_SECONDS = Histogram(
+    "transcription_stage_seconds",
+    "Duration of the stages of a transcription.",
+    DURATION_BUCKETS,
+    "stage",
+)
+REAL_TIME_FACTOR = Histogram(
+    "transcription_real_time_factor",
+    "Processing time of a transcription per second of audio.",
+    RTF_BUCKETS,
+)
+QUEUE_WAIT_SECONDS = Histogram(
+    "transcription_queue_wait_seconds",
+    "Time a transcription waited in the queue before it started.",
+    DURATION_BUCKETS,
+)
+EVENT_LOOP_LAG_SECONDS = Histogram(
+    "event_loop_lag_seconds",
+    "Delay of the event loop in running a scheduled callback.",
+    LAG_BUCKETS,
+)
+JOBS = Counter(
+    "transcription_jobs_total", "Finished transcriptions by outcome.", "status"
+)
+
+
+def resident_memory() -> float | None:
+    # Resident set size of the process in bytes, only available on Linux.
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def render(gauges: dict[str, tuple[str, float]]) -> str:
+    # gauges maps the metric name to its help text and current value
+    lines = []
+    for metric in (
+        STAGE_SECONDS,
+        REAL_TIME_FACTOR,
+        QUEUE_WAIT_SECONDS,
+        EVENT_LOOP_LAG_SECONDS,
+        JOBS,
+    ):
+        lines.extend(metric.render())
+
+    rss = resident_memory()
+    if rss is not None:
+        gauges = {
+            **gauges,
+            "process_resident_memory_bytes": ("Resident memory size in bytes.", rss),
+        }
+    for name, (help, value) in gauges.items():
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {format_value(value)}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,118 @@
+import asyncio
+import bisect
+from collections import Counter, deque
+import itertools
+
+
+class JobScheduler:
+    # Fair-share queue. Every user has their own queue, users are served round-robin
+    # and at most max_user_workers jobs of a user run at the same time.
+    #
+    # Within the queue of a user the shortest job comes first, with aging: the
+    # priority of a job is its audio length minus aging_rate seconds for every second
+    # it has been waiting. Since all queued jobs age at the same rate, the order only
+    # depends on
+    #   audio_length + aging_rate * enqueue time
+    # which is fixed when the job is queued. The queues are kept sorted by that key,
+    # so the rank of a job is a binary search and no re-ordering is ever needed.
+    # A job waits at most audio_length / aging_rate seconds for shorter jobs.
+    def __init__(self, aging_rate: float, max_user_workers: int):
+        self.aging_rate = aging_rate
+        self.max_user_workers = max_user_workers
+        # user id -> sorted (key, sequence number, item id)
+        self.queues: dict[str, list[tuple[float, int, str]]] = {}
+        # Users with queued jobs, in the order they are served
+        self.rotation: deque[str] = deque()
+        self.entries: dict[str, tuple[float, int, str]] = {}
+        self.items: dict[str, object] = {}
+        self.running: Counter[str] = Counter()
+        self.getters: deque[asyncio.Future] = deque()
+        self.counter = itertools.count()
+
+    def qsize(self, user_id: str = None) -> int:
+        if user_id is not None:
+            return len(self.queues.get(user_id, ()))
+        return len(self.entries)
+
+    def put_nowait(self, item):
+        # item needs id, user_id, audio_length and timestamp (datetime of the upload).
+        key = item.audio_length + self.aging_rate * item.timestamp.timestamp()
+        entry = (key, next(self.counter), item.id)
+        if item.user_id not in self.queues:
+            self.queues[item.user_id] = []
+            self.rotation.append(item.user_id)
+        bisect.insort(self.queues[item.user_id], entry)
+        self.entries[item.id] = entry
+        self.items[item.id] = item
+        self._wakeup()
+
+    async def get(self):
+        while (user_id := self._next_user()) is None:
+            getter = asyncio.get_running_loop().create_future()
+            self.getters.append(getter)
+            try:
+                await getter
+            except asyncio.CancelledError:
+                if getter in self.getters:
+                    self.getters.remove(getter)
+                elif self._next_user() is not None:
+                    # Pass the wakeup on to the next worker.
+                    self._wakeup()
+                raise
+
+        queue = self.queues[user_id]
+        _, _, item_id = queue.pop(0)
+        self.rotation.remove(user_id)
+        if queue:
+            self.rotation.append(user_id)
+        else:
+            del self.queues[user_id]
+        self.running[user_id] += 1
+        del self.entries[item_id]
+        return self.items.pop(item_id)
+
+    def task_done(self, item):
+        self.running[item.user_id] -= 1
+        if not self.running[item.user_id]:
+            del self.running[item.user_id]
+        self._wakeup()
+
+    def position(self, item_id: str) -> int:
+        # 1-based position of a queued job in the round-robin order, 0 if it is not
+        # queued. A job with rank r in its user's queue is started after the first
+        # r + 1 jobs of the users served before and the first r jobs of the others.
+        if item_id not in self.entries:
+            return 0
+        user_id = self.items[item_id].user_id
+        rank = bisect.bisect_left(self.queues[user_id], self.entries[item_id])
+        position = rank + 1
+        before = True
+        for other in self.rotation:
+            if other == user_id:
+                before = False
+                continue
+            position += min(len(self.queues[other]), rank + 1 if before else rank)
+        return position
+
+    def queued(self) -> list:
+        # Queued jobs in the order they will be started, ignoring the per-user limit.
+        queues = [self.queues[user_id] for user_id in self.rotation]
+        return [
+            self.items[entry[2]]
+            for entries in itertools.zip_longest(*queues)
+            for entry in entries
+            if entry is not None
+        ]
+
+    def _next_user(self) -> str | None:
+        for user_id in self.rotation:
+            if self.running[user_id] < self.max_user_workers:
+                return user_id
+        return None
+
+    def _wakeup(self):
+        while self.getters:
+            getter = self.getters.popleft()
+            if not getter.done():
+                getter.set_result(None)
+                break
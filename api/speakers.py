@@ -0,0 +1,79 @@
+import numpy as np
+
+
+def assign_speakers(
+    turns: list[tuple[float, float, str]], segments: list[dict]
+) -> list[dict]:
+    # Set the speaker of every segment and word to the speaker whose turns overlap it
+    # the longest, with the same result as whisperx.assign_word_speakers: only turns
+    # with a positive overlap count, the overlaps are summed per speaker, ties go to
+    # the alphabetically first speaker and without any overlap no speaker is set.
+    # Words without timestamps are skipped. The segments are changed in place.
+    items = []
+    for segment in segments:
+        items.append(segment)
+        items.extend(word for word in segment.get("words", ()) if "start" in word)
+    if not items or not turns:
+        return segments
+
+    starts = np.array([item["start"] for item in items], dtype=float)
+    ends = np.array([item["end"] for item in items], dtype=float)
+    speakers, best = _longest_overlap(turns, starts, ends)
+    for item, speaker in zip(items, best.tolist()):
+        if speaker >= 0:
+            item["speaker"] = speakers[speaker]
+    return segments
+
+
+def _longest_overlap(turns, starts, ends):
+    # Index of the speaker overlapping each interval [starts[i], ends[i]] the
+    # longest, or -1. The turns are sorted by start and the candidates of an interval
+    # are found by binary search, so the cost grows with the number of intervals and
+    # the turns that actually overlap them, not with intervals x turns.
+    turn_starts = np.array([turn[0] for turn in turns], dtype=float)
+    turn_ends = np.array([turn[1] for turn in turns], dtype=float)
+    speakers, turn_speakers = np.unique(
+        [turn[2] for turn in turns], return_inverse=True
+    )
+    order = np.argsort(turn_starts, kind="stable")
+    turn_starts = turn_starts[order]
+    turn_ends = turn_ends[order]
+    turn_speakers = turn_speakers[order]
+
+    # Turns before first can not overlap, as all of them end before the interval
+    # starts. The turns from last on start after it ends.
+    first = np.searchsorted(np.maximum.accumulate(turn_ends), starts, side="right")
+    last = np.searchsorted(turn_starts, ends, side="left")
+    counts = np.maximum(last - first, 0)
+
+    # One row per candidate pair of interval and turn
+    interval = np.repeat(np.arange(len(starts)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    turn = np.repeat(first, counts) + offsets
+    overlap = np.minimum(turn_ends[turn], ends[interval]) - np.maximum(
+        turn_starts[turn], starts[interval]
+    )
+    positive = overlap > 0
+    if not positive.any():
+        return speakers.tolist(), np.full(len(starts), -1)
+    interval = interval[positive]
+    speaker = turn_speakers[turn][positive]
+    overlap = overlap[positive]
+
+    # Sum the overlaps per interval and speaker
+    order = np.lexsort((speaker, interval))
+    interval = interval[order]
+    speaker = speaker[order]
+    group_starts = np.flatnonzero(
+        np.r_[True, (interval[1:] != interval[:-1]) | (speaker[1:] != speaker[:-1])]
+    )
+    totals = np.add.reduceat(overlap[order], group_starts)
+    interval = interval[group_starts]
+    speaker = speaker[group_starts]
+
+    # The longest total of every interval, on ties the first speaker
+    order = np.lexsort((speaker, -totals, interval))
+    is_first = np.r_[True, interval[order][1:] != interval[order][:-1]]
+    best = np.full(len(starts), -1)
+    best[interval[order][is_first]] = speaker[order][is_first]
+    return speakers.tolist(), best
@@ -1,120 +1,155 @@
-import copy
 import datetime
+from itertools import accumulate
 
+MAX_LENGTH = 60
+HARD_MAX_LENGTH = 80
+LINE_LENGTH = 40
+CHARACTERS_PER_SECOND = 13
 
-def create_srt(data):
-    data_srt = []
-    max_length = 60
-    hard_max_length = 80
 
-    # Try to split segments into sub-segments of max. max_length characters.
-    # Segments shorter than max_length characters are not changed.
-    for segment in data:
-        segment["text"] = segment["text"]
-        text = segment["text"].strip()
-        length = len(text.replace(" ", ""))
-        if length < max_length:
-            data_srt.append(copy.deepcopy(segment))
-        else:
-            target_number_of_splits = int(length / (max_length)) + 1
-            target_length = length / target_number_of_splits
-            word_index = 0
-
-            while word_index < len(segment["words"]):
-                new_segment = {"start": -1, "end": -1, "words": [], "text": ""}
-                while word_index < len(segment["words"]):
-                    # Add a word to the current new_segment.
-                    if (
-                        new_segment["start"] == -1
-                        and "start" in segment["words"][word_index]
-                    ):
-                        new_segment["start"] = segment["words"][word_index]["start"]
-                    if "end" in segment["words"][word_index]:
-                        new_segment["end"] = segment["words"][word_index]["end"]
-
-                    new_segment["words"].append(
-                        copy.deepcopy(segment["words"][word_index])
-                    )
-                    new_segment["text"] += segment["words"][word_index]["word"] + " "
-
-                    # Check if word_index is a good position to start a new segment.
-                    word_index += 1
-                    current_length = len(new_segment["text"].replace(" ", ""))
-                    # If hard_max_length will be reached after the next word, start a new segment.
-                    if word_index >= len(segment["words"]) or hard_max_length < (
-                        current_length + len(segment["words"][word_index]["word"])
-                    ):
-                        break
-                    # Do not start a new segment towards the end.
-                    if word_index + 2 > len(segment["words"]):
-                        continue
-                    # Allow early starting of a new segment if the current word contains ','/'»' or the next word contains 'und'/'oder'/'«'.
-                    if current_length > target_length * 0.5 and (
-                        "," in segment["words"][word_index - 1]["word"]
-                        or "«" in segment["words"][word_index]["word"]
-                        or "»" in segment["words"][word_index - 1]["word"]
-                        or "und" in segment["words"][word_index]["word"]
-                        or "oder" in segment["words"][word_index]["word"]
-                    ):
-                        break
-                    if abs(target_length - current_length) < abs(
-                        target_length
-                        - (current_length + len(segment["words"][word_index]["word"]))
-                    ):
-                        break
-                data_srt.append(copy.deepcopy(new_segment))
-
-    # Try to increase display times of segments to 13 characters per second if possible.
-    for i, segment in enumerate(data_srt):
-        length = len(segment["text"].replace(" ", ""))
-        display_time = segment["end"] - segment["start"]
+def iter_cues(data):
+    # (start, end, text) of every subtitle. The segments are read only and the cues
+    # are produced one after another, with a lookahead of one cue for the display
+    # time.
+    cues = split_segments(data)
+    cue = next(cues, None)
+    while cue is not None:
+        next_cue = next(cues, None)
+        start, end, text = cue
 
+        # Try to increase display times of segments to 13 characters per second if possible.
+        length = len(text.replace(" ", ""))
+        display_time = end - start
         if (
-            i + 1 < len(data_srt)
-            and (length / 13) < display_time
-            and data_srt[i + 1]["start"] > segment["end"]
+            next_cue is not None
+            and (length / CHARACTERS_PER_SECOND) < display_time
+            and next_cue[0] > end
         ):
-            optimal_time_increase = display_time - (length / 13)
-            segment["end"] = min(
-                data_srt[i + 1]["start"], segment["end"] + optimal_time_increase
-            )
-
-    text = ""
-    for i, segment in enumerate(data_srt):
-        text += str(i + 1) + "\n"
-        text += (
-            "{:0>8}".format(str(datetime.timedelta(seconds=int(segment["start"]))))
-            + ","
-            + str(int(segment["start"] % 1 * 1000)).ljust(3, "0")
-            + " --> "
-            + "{:0>8}".format(str(datetime.timedelta(seconds=int(segment["end"]))))
-            + ","
-            + str(int(segment["end"] % 1 * 1000)).ljust(3, "0")
-            + "\n"
-        )
-
-        segment_text = segment["text"].strip()
-        length = len(segment_text.replace(" ", ""))
-        if length > 40:
-            segment_tokens = segment_text.split(" ")
-            segment_tokens_lengths = [len(token) for token in segment_tokens]
-            new_line_position = 0
-            best_difference = 10000
-            for index in range(len(segment_tokens_lengths)):
-                difference = abs(
-                    sum(segment_tokens_lengths[index:])
-                    - sum(segment_tokens_lengths[:index])
-                )
-                if best_difference > difference:
-                    best_difference = difference
-                    new_line_position = index
-            segment_text = (
-                " ".join(segment_tokens[:new_line_position])
-                + "\n"
-                + " ".join(segment_tokens[new_line_position:])
-            )
-
-        text += f"{segment_text}\n\n"
-
-    text = text.replace("ß", "ss")
-    return text
+            optimal_time_increase = display_time - (length / CHARACTERS_PER_SECOND)
+            end = min(next_cue[0], end + optimal_time_increase)
+
+        yield start, end, break_line(text.strip()).replace("ß", "ss")
+        cue = next_cue
+
+
+def split_segments(data):
+    # Try to split segments into sub-segments of max. MAX_LENGTH characters.
+    # Segments shorter than MAX_LENGTH characters are not changed.
+    for segment in data:
+        length = len(segment["text"].strip().replace(" ", ""))
+        if length < MAX_LENGTH:
+            yield segment["start"], segment["end"], segment["text"]
+            continue
+
+        words = segment["words"]
+        word_lengths = [len(word["word"]) for word in words]
+        # The length of a sub-segment does not count spaces
+        text_lengths = [len(word["word"].replace(" ", "")) for word in words]
+        target_number_of_splits = int(length / MAX_LENGTH) + 1
+        target_length = length / target_number_of_splits
+
+        first = 0
+        while first < len(words):
+            word_index = first
+            current_length = 0
+            while True:
+                # Add a word to the current sub-segment.
+                current_length += text_lengths[word_index]
+                word_index += 1
+
+                # Check if word_index is a good position to start a new segment.
+                # If HARD_MAX_LENGTH will be reached after the next word, start a new segment.
+                if word_index >= len(words) or HARD_MAX_LENGTH < (
+                    current_length + word_lengths[word_index]
+                ):
+                    break
+                # Do not start a new segment towards the end.
+                if word_index + 2 > len(words):
+                    continue
+                # Allow early starting of a new segment if the current word contains ','/'»' or the next word contains 'und'/'oder'/'«'.
+                if current_length > target_length * 0.5 and (
+                    "," in words[word_index - 1]["word"]
+                    or "«" in words[word_index]["word"]
+                    or "»" in words[word_index - 1]["word"]
+                    or "und" in words[word_index]["word"]
+                    or "oder" in words[word_index]["word"]
+                ):
+                    break
+                if abs(target_length - current_length) < abs(
+                    target_length - (current_length + word_lengths[word_index])
+                ):
+                    break
+
+            yield sub_segment(words, first, word_index)
+            first = word_index
+
+
+def sub_segment(words, first, last):
+    # Start of the first and end of the last word with timestamps, -1 if none has.
+    start = end = -1
+    text = []
+    for word in words[first:last]:
+        if start == -1 and "start" in word:
+            start = word["start"]
+        if "end" in word:
+            end = word["end"]
+        text.append(word["word"] + " ")
+    return start, end, "".join(text)
+
+
+def break_line(text):
+    # Split texts of more than LINE_LENGTH characters into two lines of about the
+    # same length.
+    if len(text.replace(" ", "")) <= LINE_LENGTH:
+        return text
+    tokens = text.split(" ")
+    prefix_lengths = list(accumulate((len(token) for token in tokens), initial=0))
+    total_length = prefix_lengths[-1]
+    new_line_position = 0
+    best_difference = 10000
+    for index in range(len(tokens)):
+        difference = abs(total_length - 2 * prefix_lengths[index])
+        if best_difference > difference:
+            best_difference = difference
+            new_line_position = index
+    return (
+        " ".join(tokens[:new_line_position])
+        + "\n"
+        + " ".join(tokens[new_line_position:])
+    )
+
+
+def srt_timestamp(seconds):
+    return (
+        "{:0>8}".format(str(datetime.timedelta(seconds=int(seconds))))
+        + ","
+        + str(int(seconds % 1 * 1000)).ljust(3, "0")
+    )
+
+
+def vtt_timestamp(seconds):
+    milliseconds = round(max(seconds, 0) * 1000)
+    hours, milliseconds = divmod(milliseconds, 3_600_000)
+    minutes, milliseconds = divmod(milliseconds, 60_000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}.{milliseconds:03d}"
+
+
+def iter_srt(data):
+    # The SRT file cue by cue, e.g. for a StreamingResponse or file.writelines.
+    for i, (start, end, text) in enumerate(iter_cues(data)):
+        yield f"{i + 1}\n{srt_timestamp(start)} --> {srt_timestamp(end)}\n{text}\n\n"
+
+
+def iter_vtt(data):
+    yield "WEBVTT\n\n"
+    for start, end, text in iter_cues(data):
+        yield f"{vtt_timestamp(start)} --> {vtt_timestamp(end)}\n{text}\n\n"
+
+
+def create_srt(data):
+    return "".join(iter_srt(data))
+
+
+def create_vtt(data):
+    return "".join(iter_vtt(data))
@@ -1,116 +1,134 @@
+from concurrent.futures import ThreadPoolExecutor, wait
 import time
 
-import pandas as pd
-import torch
-import whisperx
-from whisperx.audio import N_SAMPLES, SAMPLE_RATE, log_mel_spectrogram
-
-from const import data_leaks
-
-
-def get_prompt(self, tokenizer, previous_tokens, without_timestamps, prefix):
-    prompt = []
-
-    if previous_tokens or prefix:
-        prompt.append(tokenizer.sot_prev)
-        if prefix:
-            hotwords_tokens = tokenizer.encode(" " + prefix.strip())
-            if len(hotwords_tokens) >= self.max_length // 2:
-                hotwords_tokens = hotwords_tokens[: self.max_length // 2 - 1]
-            prompt.extend(hotwords_tokens)
-        if prefix and previous_tokens:
-            prompt.extend(previous_tokens[-(self.max_length // 2 - 1) :])
-
-    prompt.extend(tokenizer.sot_sequence)
-
-    if without_timestamps:
-        prompt.append(tokenizer.no_timestamps)
-
-    return prompt
-
-
-def detect_language(audio, model):
-    model_n_mels = model.model.feat_kwargs.get("feature_size")
-    segment = log_mel_spectrogram(
-        audio[:N_SAMPLES],
-        n_mels=model_n_mels if model_n_mels is not None else 80,
-        padding=0 if audio.shape[0] >= N_SAMPLES else N_SAMPLES - audio.shape[0],
-    )
-    encoder_output = model.model.encode(segment)
-    results = model.model.model.detect_language(encoder_output)
-    language_token, language_probability = results[0][0]
-    language = language_token[2:-2]
-    return (language, language_probability)
+from leaks import data_leak_patterns
+from speakers import assign_speakers
 
 
 def transcribe(
-    complete_name,
-    model,
-    diarize_model,
-    device,
+    audio,
+    backend,
     num_speaker,
     add_language=False,
     hotwords=[],
     batch_size=4,
+    langid_batch_size=16,
+    on_stage=None,
+    on_parallel_stage=None,
+    trace=None,
+    checkpoints=None,
+    parallel_diarization=False,
 ):
-    torch.cuda.empty_cache()
-
-    # Convert audio given a file path.
-    audio = whisperx.load_audio(complete_name)
-
-    start = time.time()
-    if len(hotwords) > 0:
-        model.options = model.options._replace(prefix=" ".join(hotwords))
-    result1 = model.transcribe(audio, batch_size=batch_size, language="de")
-    if len(hotwords) > 0:
-        model.options = model.options._replace(prefix=None)
-    print(str(time.time() - start))
+    # on_stage is called with the name of every stage when it starts, and
+    # on_parallel_stage with the name, start and end (time.monotonic()) of a stage
+    # that ran besides the others. If trace is a dict, the sizes of the intermediate
+    # results are recorded in it. With checkpoints, the results that only depend on
+    # the audio are reused.
+    report_stage = on_stage or (lambda stage: None)
+    report_parallel_stage = on_parallel_stage or (lambda stage, start, end: None)
+
+    # The diarization only needs the audio. With parallel_diarization it runs in its
+    # own thread during the transcription and is joined at the speaker assignment.
+    # The thread measures the diarization itself, the stage of the join only covers
+    # the wait for it.
+    diarization = None
+    if parallel_diarization:
+
+        def timed_diarize():
+            start = time.monotonic()
+            turns = diarize(audio, backend, num_speaker, checkpoints)
+            report_parallel_stage("diarize", start, time.monotonic())
+            return turns
+
+        pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="diarization")
+        diarization = pool.submit(timed_diarize)
+        pool.shutdown(wait=False)
+
+    try:
+        language, result2 = transcribe_text(
+            audio,
+            backend,
+            add_language,
+            hotwords,
+            batch_size,
+            langid_batch_size,
+            report_stage,
+            trace,
+            checkpoints,
+        )
+    except BaseException:
+        # The next job must not start while the diarization still uses the models
+        if diarization is not None:
+            wait([diarization])
+        raise
+
+    if diarization is not None:
+        report_stage("diarize_wait")
+        turns = diarization.result()
+    else:
+        report_stage("diarize")
+        turns = diarize(audio, backend, num_speaker, checkpoints)
+    if trace is not None:
+        trace["diarization_turns"] = len(turns)
+
+    report_stage("assign")
+    segments = assign_speakers(turns, result2["segments"])
+
+    return remove_data_leaks(segments, language)
+
+
+def transcribe_text(
+    audio,
+    backend,
+    add_language,
+    hotwords,
+    batch_size,
+    langid_batch_size,
+    report_stage,
+    trace,
+    checkpoints,
+):
+    # Transcription, alignment and language detection of the segments.
+    report_stage("asr")
+    result1 = backend.transcribe(audio, hotwords, batch_size, checkpoints)
+    if trace is not None:
+        trace["language"] = result1["language"]
+        trace["asr_segments"] = len(result1["segments"])
 
     # Align whisper output.
-    model_a, metadata = whisperx.load_align_model(
-        language_code=result1["language"], device=device
-    )
-    result2 = whisperx.align(
-        result1["segments"],
-        model_a,
-        metadata,
-        audio,
-        device,
-        return_char_alignments=False,
-    )
+    report_stage("align")
+    result2 = backend.align(result1["segments"], result1["language"], audio)
 
     if add_language:
-        for segment in result2["segments"]:
-            start = (int(segment["start"]) * 16_000) - 8_000
-            end = ((int(segment["end"]) + 1) * 16_000) + 8_000
-            segment_audio = audio[start:end]
-            language, language_probability = detect_language(segment_audio, model)
+        report_stage("langid")
+        languages = backend.detect_languages(
+            audio, result2["segments"], langid_batch_size
+        )
+        for segment, (language, language_probability) in zip(
+            result2["segments"], languages
+        ):
             segment["language"] = language if language_probability > 0.85 else "de"
 
-    # Diarize and assign speaker labels.
-    audio_data = {
-        "waveform": torch.from_numpy(audio[None, :]),
-        "sample_rate": SAMPLE_RATE,
-    }
+    return result1["language"], result2
 
-    segments = diarize_model(audio_data, num_speakers=num_speaker)
-    diarize_df = pd.DataFrame(
-        segments.itertracks(yield_label=True), columns=["segment", "label", "speaker"]
-    )
-    diarize_df["start"] = diarize_df["segment"].apply(lambda x: x.start)
-    diarize_df["end"] = diarize_df["segment"].apply(lambda x: x.end)
 
-    result3 = whisperx.assign_word_speakers(diarize_df, result2)
+def diarize(audio, backend, num_speaker, checkpoints):
+    turns = checkpoints.load_turns(num_speaker) if checkpoints is not None else None
+    if turns is None:
+        turns = backend.diarize(audio, num_speaker)
+        if checkpoints is not None:
+            checkpoints.save_turns(num_speaker, turns)
+    return turns
 
-    torch.cuda.empty_cache()
 
-    # Text cleanup.
+def remove_data_leaks(segments, language):
+    # Remove phrases Whisper hallucinates from its training data (e.g. subtitle
+    # credits) and drop the segments that are empty afterwards.
+    pattern = data_leak_patterns.get(language)
     cleaned_segments = []
-    for segment in result3["segments"]:
-        if result1["language"] in data_leaks:
-            for line in data_leaks[result1["language"]]:
-                if line in segment["text"]:
-                    segment["text"] = segment["text"].replace(line, "")
+    for segment in segments:
+        if pattern is not None:
+            segment["text"] = pattern.sub("", segment["text"])
         segment["text"] = segment["text"].strip()
 
         if len(segment["text"]) > 0:
@@ -1,4 +1,6 @@
 import datetime
+from functools import lru_cache
+import json
 import os
 
 from dotenv import load_dotenv
@@ -9,25 +11,44 @@ ADDITIONAL_SPEAKERS = int(os.getenv("ADDITIONAL_SPEAKERS"))
 
 
 # Function to generate the viewer html-file.
-# Input data is the segments of the output of whisperx.assign_word_speakers: whisperx.assign_word_speakers(diarize_df, result2)['segments']
+# Input data is the segments of the output of speakers.assign_speakers.
 # File_path is the path to the audio/video file.
-def create_viewer(data, file_path, encode_base64, combine_speaker, root):
+# With compact the transcript is embedded as JSON and rendered in the browser.
+def create_viewer(data, file_path, encode_base64, combine_speaker, root, compact=False):
     for segment in data:
         if "speaker" not in segment:
             segment["speaker"] = "unknown"
     file_name = str(os.path.basename(file_path))
-
-    html = header(root)
-    html += navbar(root)
-    html += video(file_name, encode_base64)
-    html += buttons()
-    html += meta_data(file_name, encode_base64)
-    html += speaker_information(data)
-    html += transcript(data, combine_speaker)
-    html += javascript(data, file_path, encode_base64, file_name)
-    return html
+    speakers = speaker_list(data)
+
+    html = [
+        header(root),
+        navbar(root),
+        video(file_name, encode_base64),
+        buttons(),
+        meta_data(file_name, encode_base64),
+        speaker_information(speakers),
+        transcript(data, combine_speaker, speakers, compact),
+        javascript(data, file_path, encode_base64, file_name, speakers),
+    ]
+    return "".join(html)
+
+
+def speaker_list(data):
+    # The sorted speakers of the transcript, the additional speakers to choose in
+    # the editor and "unknown".
+    speakers = sorted(
+        {segment["speaker"] for segment in data if segment["speaker"] != "unknown"}
+    )
+    n_speakers = len(speakers)
+    for i in range(ADDITIONAL_SPEAKERS):
+        speakers.append(str(n_speakers + i).zfill(2))
+    speakers.append("unknown")
+    return speakers
 
 
+# The static parts are the same for every viewer, they are read once per process.
+@lru_cache
 def header(root):
     content = ""
     with open(root + "data/bootstrap_content.txt", "r") as f:
@@ -40,6 +61,7 @@ def header(root):
     return content
 
 
+@lru_cache
 def navbar(root):
     with open(root + "data/logo.txt", "r") as f:
         logo = f.read()
@@ -74,32 +96,19 @@ def meta_data(file_name, encode_base64):
     return content
 
 
-def speaker_information(data):
-    content = '\t\t\t\t<div style="margin-top:10px;" class="viewer-hidden">\n'
-    speakers = sorted(
-        set(
-            [
-                segment["speaker"]
-                for segment in data
-                if segment["speaker"] != "unknown"
-            ]
-        )
-    )
-
-    n_speakers = len(speakers)
-    for i in range(ADDITIONAL_SPEAKERS):
-        speakers.append(str(n_speakers + i).zfill(2))
-    speakers.append("unknown")
-
+def speaker_information(speakers):
+    content = ['\t\t\t\t<div style="margin-top:10px;" class="viewer-hidden">\n']
     for idx, speaker in enumerate(speakers):
         if speaker != "unknown":
-            content += f'\t\t\t\t\t<span contenteditable="true" class="form-control" id="IN_SPEAKER_{str(idx).zfill(2)}" style="margin-top:4px;">Person {speaker[-2:]}</span>\n'
+            content.append(
+                f'\t\t\t\t\t<span contenteditable="true" class="form-control" id="IN_SPEAKER_{str(idx).zfill(2)}" style="margin-top:4px;">Person {speaker[-2:]}</span>\n'
+            )
 
-    content += "\t\t\t\t<br><br><br><br><br></div>\n"
-    content += "\t\t\t\t</div>\n"
-    content += "\t\t\t</div>\n"
-    content += "\t\t</div>\n"
-    return content
+    content.append("\t\t\t\t<br><br><br><br><br></div>\n")
+    content.append("\t\t\t\t</div>\n")
+    content.append("\t\t\t</div>\n")
+    content.append("\t\t</div>\n")
+    return "".join(content)
 
 
 def buttons():
@@ -114,128 +123,208 @@ def buttons():
     return content
 
 
-def segment_buttons():
-    return "<button style='float: right;' class='btn btn-danger btn-sm' onclick='removeRow(this)'><svg xmlns='http://www.w3.org/2000/svg' width='16' height='16' fill='currentColor' class='bi bi-trash' viewBox='0 0 16 16'><path d='M5.5 5.5A.5.5 0 0 1 6 6v6a.5.5 0 0 1-1 0V6a.5.5 0 0 1 .5-.5m2.5 0a.5.5 0 0 1 .5.5v6a.5.5 0 0 1-1 0V6a.5.5 0 0 1 .5-.5m3 .5a.5.5 0 0 0-1 0v6a.5.5 0 0 0 1 0z'/><path d='M14.5 3a1 1 0 0 1-1 1H13v9a2 2 0 0 1-2 2H5a2 2 0 0 1-2-2V4h-.5a1 1 0 0 1-1-1V2a1 1 0 0 1 1-1H6a1 1 0 0 1 1-1h2a1 1 0 0 1 1 1h3.5a1 1 0 0 1 1 1zM4.118 4 4 4.059V13a1 1 0 0 0 1 1h6a1 1 0 0 0 1-1V4.059L11.882 4zM2.5 3h11V2h-11z'/></svg></button><button style='float: right;' class='btn btn-primary btn-sm' onclick='addRow(this)'><svg xmlns='http://www.w3.org/2000/svg' width='16' height='16' fill='currentColor' class='bi bi-plus' viewBox='0 0 16 16'><path d='M8 4a.5.5 0 0 1 .5.5v3h3a.5.5 0 0 1 0 1h-3v3a.5.5 0 0 1-1 0v-3h-3a.5.5 0 0 1 0-1h3v-3A.5.5 0 0 1 8 4'/></svg></button>"
-
+SEGMENT_BUTTONS = "<button style='float: right;' class='btn btn-danger btn-sm' onclick='removeRow(this)'><svg xmlns='http://www.w3.org/2000/svg' width='16' height='16' fill='currentColor' class='bi bi-trash' viewBox='0 0 16 16'><path d='M5.5 5.5A.5.5 0 0 1 6 6v6a.5.5 0 0 1-1 0V6a.5.5 0 0 1 .5-.5m2.5 0a.5.5 0 0 1 .5.5v6a.5.5 0 0 1-1 0V6a.5.5 0 0 1 .5-.5m3 .5a.5.5 0 0 0-1 0v6a.5.5 0 0 0 1 0z'/><path d='M14.5 3a1 1 0 0 1-1 1H13v9a2 2 0 0 1-2 2H5a2 2 0 0 1-2-2V4h-.5a1 1 0 0 1-1-1V2a1 1 0 0 1 1-1H6a1 1 0 0 1 1-1h2a1 1 0 0 1 1 1h3.5a1 1 0 0 1 1 1zM4.118 4 4 4.059V13a1 1 0 0 0 1 1h6a1 1 0 0 0 1-1V4.059L11.882 4zM2.5 3h11V2h-11z'/></svg></button><button style='float: right;' class='btn btn-primary btn-sm' onclick='addRow(this)'><svg xmlns='http://www.w3.org/2000/svg' width='16' height='16' fill='currentColor' class='bi bi-plus' viewBox='0 0 16 16'><path d='M8 4a.5.5 0 0 1 .5.5v3h3a.5.5 0 0 1 0 1h-3v3a.5.5 0 0 1-1 0v-3h-3a.5.5 0 0 1 0-1h3v-3A.5.5 0 0 1 8 4'/></svg></button>"
 
-def transcript(data, combine_speaker):
-    content = '\t\t<div class="col-md-6" style="width: 60%; max-width: 90ch; z-index: 1; margin-left: auto; margin-right: auto">\n'
-    content += '\t\t\t<div class="wrapper" style="margin: 0.5rem auto 0; max-width: 80ch;" id="editor">\n'
 
-    speakers = sorted(
-        set(
-            [
-                segment["speaker"]
-                for segment in data
-                if segment["speaker"] != "unknown"
-            ]
+def speaker_select(speakers, speaker_idx):
+    content = ["\t\t\t\t\t", '<select onchange="selectChange(this)">\n']
+    for idx, speaker in enumerate(speakers):
+        selected = ' selected="selected"' if idx == speaker_idx else ""
+        if speaker == "unknown":
+            name = "Person unbekannt"
+        else:
+            name = f"Person {str(speaker[-2:]).zfill(2)}"
+        content.append(
+            f'\t\t\t\t\t\t<option value="{str(idx).zfill(2)}" class="OUT_SPEAKER_{str(idx).zfill(2)}"{selected}>{name}</option>\n'
         )
-    )
-    n_speakers = len(speakers)
-    for i in range(ADDITIONAL_SPEAKERS):
-        speakers.append(str(n_speakers + i).zfill(2))
-    speakers.append("unknown")
-    speaker_order = []
-    table_elements = ""
-    last_speaker = None
+    content.append("\t\t\t\t\t</select>\n")
+    return "".join(content)
+
+
+def transcript(data, combine_speaker, speakers, compact=False):
+    content = [
+        '\t\t<div class="col-md-6" style="width: 60%; max-width: 90ch; z-index: 1; margin-left: auto; margin-right: auto">\n',
+        '\t\t\t<div class="wrapper" style="margin: 0.5rem auto 0; max-width: 80ch;" id="editor">\n',
+    ]
+    speaker_order = speaker_positions(data, speakers)
+    if compact:
+        content.append(compact_rows(data, combine_speaker, speakers, speaker_order))
+    else:
+        content.append(rows(data, combine_speaker, speakers, speaker_order))
+    content.append("\t\t</div>\n")
+    content.append("\t</div>\n")
+    content.append("</body>\n")
+    content.append("</html>\n\n")
+    return "".join(content)
+
+
+def speaker_positions(data, speakers):
+    # The selected option is the position of the speaker in the order of appearance,
+    # followed by the additional speakers and "unknown". The options are in the
+    # order of speakers.
+    speaker_order = {}
     for segment in data:
-        if (
-            segment["speaker"] not in speaker_order
-            and segment["speaker"] != "unknown"
-        ):
-            speaker_order.append(segment["speaker"])
+        if segment["speaker"] != "unknown":
+            speaker_order.setdefault(segment["speaker"], len(speaker_order))
+    position = len(speaker_order)
+    for speaker in speakers[len(speakers) - ADDITIONAL_SPEAKERS - 1 :]:
+        speaker_order.setdefault(speaker, position)
+        position += 1
+    return speaker_order
 
-    for i in range(ADDITIONAL_SPEAKERS):
-        speaker_order.append(str(n_speakers + i).zfill(2))
-    speaker_order.append("unknown")
 
+def rows(data, combine_speaker, speakers, speaker_order):
+    # A row per segment, with the speaker selection, start time and buttons in the
+    # first row of a speaker turn. The <select> is the same for all turns of a speaker.
+    content = []
+    selects = {}
+
+    last_speaker = None
     for i, segment in enumerate(data):
         if last_speaker is not None and not segment["speaker"][-1] == last_speaker:
-            table_elements += "\t\t\t\t\t</p>\n"
-            table_elements += "\t\t\t</div>\n"
-        table_elements += "\t\t\t<div>\n"
+            content.append("\t\t\t\t\t</p>\n")
+            content.append("\t\t\t</div>\n")
+        content.append("\t\t\t<div>\n")
+        start = str(datetime.timedelta(seconds=round(segment["start"], 0)))
         if last_speaker is None or not segment["speaker"][-1] == last_speaker:
-            table_elements += (
+            content.append(
                 '\t\t\t\t\t<div style="display: block; margin-bottom: 0.5rem;">\n'
             )
-            table_elements += "\t\t\t\t\t"
-            table_elements += f'<select onchange="selectChange(this)">\n'
-            speaker_idx = speaker_order.index(segment["speaker"])
-            for idx, speaker in enumerate(speakers):
-                if idx == speaker_idx:
-                    if speaker == "unknown":
-                        table_elements += f'\t\t\t\t\t\t<option value="{str(idx).zfill(2)}" class="OUT_SPEAKER_{str(idx).zfill(2)}" selected="selected">Person unbekannt</option>\n'
-                    else:
-                        table_elements += f'\t\t\t\t\t\t<option value="{str(idx).zfill(2)}" class="OUT_SPEAKER_{str(idx).zfill(2)}" selected="selected">Person {str(speaker[-2:]).zfill(2)}</option>\n'
-                else:
-                    if speaker == "unknown":
-                        table_elements += f'\t\t\t\t\t\t<option value="{str(idx).zfill(2)}" class="OUT_SPEAKER_{str(idx).zfill(2)}">Person unbekannt</option>\n'
-                    else:
-                        table_elements += f'\t\t\t\t\t\t<option value="{str(idx).zfill(2)}" class="OUT_SPEAKER_{str(idx).zfill(2)}">Person {str(speaker[-2:]).zfill(2)}</option>\n'
-            table_elements += "\t\t\t\t\t</select>\n"
-            table_elements += (
-                '\t\t\t\t\t<span contenteditable="true">'
-                + str(datetime.timedelta(seconds=round(segment["start"], 0)))
-                + "</span>\n"
-            )
+            speaker_idx = speaker_order[segment["speaker"]]
+            if speaker_idx not in selects:
+                selects[speaker_idx] = speaker_select(speakers, speaker_idx)
+            content.append(selects[speaker_idx])
+            content.append(f'\t\t\t\t\t<span contenteditable="true">{start}</span>\n')
             if "language" in segment:
                 if segment["language"] in ["de", "en", "nl"]:
-                    table_elements += '\t\t\t\t\t<input type="checkbox" class="language" name="language" value="Fremdsprache" style="margin-left: 5px" onclick="changeCheckbox(this)"/> <label for="language">Fremdsprache</label>\n'
+                    content.append(
+                        '\t\t\t\t\t<input type="checkbox" class="language" name="language" value="Fremdsprache" style="margin-left: 5px" onclick="changeCheckbox(this)"/> <label for="language">Fremdsprache</label>\n'
+                    )
                 else:
-                    table_elements += '\t\t\t\t\t<input type="checkbox" class="language" name="language" value="Fremdsprache" style="margin-left: 5px" onclick="changeCheckbox(this)" checked="checked" /> <label for="language">Fremdsprache</label>\n'
-
-            table_elements += "\t\t\t\t\t" + segment_buttons() + "\n"
-            table_elements += "\t\t\t\t\t</div>\n"
-            table_elements += '\t\t\t\t\t<p class="form-control">'
-        table_elements += f"<span id=\"{str(i)}\" tabindex=\"{str(i+1)}\" onclick=\"changeVideo({str(i)})\" contenteditable=\"true\" class=\"segment\" title=\"{str(datetime.timedelta(seconds=round(segment['start'], 0)))} - {str(datetime.timedelta(seconds=round(segment['end'],0)))}\">{segment['text'].strip().replace('ß', 'ss')}</span>"
-        table_elements += "\n"
+                    content.append(
+                        '\t\t\t\t\t<input type="checkbox" class="language" name="language" value="Fremdsprache" style="margin-left: 5px" onclick="changeCheckbox(this)" checked="checked" /> <label for="language">Fremdsprache</label>\n'
+                    )
+
+            content.append("\t\t\t\t\t" + SEGMENT_BUTTONS + "\n")
+            content.append("\t\t\t\t\t</div>\n")
+            content.append('\t\t\t\t\t<p class="form-control">')
+        end = str(datetime.timedelta(seconds=round(segment["end"], 0)))
+        text = segment["text"].strip().replace("ß", "ss")
+        content.append(
+            f'<span id="{i}" tabindex="{i + 1}" onclick="changeVideo({i})" contenteditable="true" class="segment" title="{start} - {end}">{text}</span>\n'
+        )
         if combine_speaker:
             last_speaker = segment["speaker"][-1]
         else:
             last_speaker = ""
 
-    content += table_elements
+    content.append("\t\t\t</p></div>\n")
+    return "".join(content)
 
-    content += "\t\t\t</p></div>\n"
-    content += "\t\t</div>\n"
-    content += "\t</div>\n"
-    content += "</body>\n"
-    content += "</html>\n\n"
-    return content
 
+def compact_rows(data, combine_speaker, speakers, speaker_order):
+    # The rows of rows() as JSON, rendered by a script in the browser. The script
+    # produces the same HTML and removes itself and the data afterwards, so the
+    # editor functions and saved files work like in the full viewer. Per row only
+    # the text, the times and, in the first row of a turn, the speaker and whether
+    # the language is foreign (null without language) are stored.
+    compact = []
+    last_speaker = None
+    for segment in data:
+        row = [
+            segment["text"].strip().replace("ß", "ss"),
+            str(datetime.timedelta(seconds=round(segment["start"], 0))),
+            str(datetime.timedelta(seconds=round(segment["end"], 0))),
+        ]
+        if last_speaker is None or not segment["speaker"][-1] == last_speaker:
+            foreign = None
+            if "language" in segment:
+                foreign = int(segment["language"] not in ["de", "en", "nl"])
+            row += [speaker_order[segment["speaker"]], foreign]
+        compact.append(row)
+        if combine_speaker:
+            last_speaker = segment["speaker"][-1]
+        else:
+            last_speaker = ""
 
-def javascript(data, file_path, encode_base64, file_name):
-    speakers = sorted(
-        set(
-            [
-                segment["speaker"]
-                for segment in data
-                if segment["speaker"] != "unknown"
-            ]
-        )
+    options = [
+        "Person unbekannt"
+        if speaker == "unknown"
+        else f"Person {str(speaker[-2:]).zfill(2)}"
+        for speaker in speakers
+    ]
+    transcript_data = json.dumps(
+        {"options": options, "rows": compact}, ensure_ascii=False, separators=(",", ":")
+    ).replace("</", "<\\/")
+    renderer = ROW_RENDERER.replace("SEGMENT_BUTTONS", json.dumps(SEGMENT_BUTTONS))
+    return (
+        f'<script type="application/json" id="transcript-data">{transcript_data}</script>'
+        f"<script>{renderer}</script>"
     )
-    n_speakers = len(speakers)
-    for i in range(ADDITIONAL_SPEAKERS):
-        speakers.append(str(n_speakers + i).zfill(2))
-    speakers.append("unknown")
 
-    speakers_array = "var speakers = Array("
-    for idx, speaker in enumerate(speakers):
-        if speaker != "unknown":
-            speakers_array += f'"IN_SPEAKER_{str(idx).zfill(2)}", '
-    if len(speakers) > 1:
-        speakers_array = speakers_array[:-2] + ")"
-    else:
-        speakers_array += ")"
-    number_of_speakers = len(
-        set(
-            [
-                segment["speaker"]
-                for segment in data
-                if segment["speaker"] != "unknown"
-            ]
-        )
-    )
+
+ROW_RENDERER = """
+(function() {
+    var data = JSON.parse(document.getElementById("transcript-data").textContent);
+    var buttons = SEGMENT_BUTTONS;
+    var selects = {};
+
+    function pad2(num) {
+        num = num.toString();
+        while (num.length < 2) num = "0" + num;
+        return num;
+    }
+
+    function select(idx) {
+        var content = '\\t\\t\\t\\t\\t<select onchange="selectChange(this)">\\n';
+        for (var j = 0; j < data.options.length; j++) {
+            content += '\\t\\t\\t\\t\\t\\t<option value="' + pad2(j) + '" class="OUT_SPEAKER_' + pad2(j) + '"'
+                + (j === idx ? ' selected="selected"' : '') + '>' + data.options[j] + '</option>\\n';
+        }
+        return content + '\\t\\t\\t\\t\\t</select>\\n';
+    }
+
+    var html = [];
+    for (var i = 0; i < data.rows.length; i++) {
+        var row = data.rows[i];
+        var turn = row.length > 3;
+        if (i > 0 && turn) {
+            html.push('\\t\\t\\t\\t\\t</p>\\n\\t\\t\\t</div>\\n');
+        }
+        html.push('\\t\\t\\t<div>\\n');
+        if (turn) {
+            if (!(row[3] in selects)) selects[row[3]] = select(row[3]);
+            html.push('\\t\\t\\t\\t\\t<div style="display: block; margin-bottom: 0.5rem;">\\n');
+            html.push(selects[row[3]]);
+            html.push('\\t\\t\\t\\t\\t<span contenteditable="true">' + row[1] + '</span>\\n');
+            if (row[4] !== null) {
+                html.push('\\t\\t\\t\\t\\t<input type="checkbox" class="language" name="language" value="Fremdsprache" style="margin-left: 5px" onclick="changeCheckbox(this)"'
+                    + (row[4] ? ' checked="checked" />' : '/>') + ' <label for="language">Fremdsprache</label>\\n');
+            }
+            html.push('\\t\\t\\t\\t\\t' + buttons + '\\n');
+            html.push('\\t\\t\\t\\t\\t</div>\\n');
+            html.push('\\t\\t\\t\\t\\t<p class="form-control">');
+        }
+        html.push('<span id="' + i + '" tabindex="' + (i + 1) + '" onclick="changeVideo(' + i + ')" contenteditable="true" class="segment" title="'
+            + row[1] + ' - ' + row[2] + '">' + row[0] + '</span>\\n');
+    }
+    html.push('\\t\\t\\t</p></div>\\n');
+
+    var script = document.currentScript;
+    script.insertAdjacentHTML("beforebegin", html.join(""));
+    document.getElementById("transcript-data").remove();
+    script.remove();
+})();
+"""
+
+
+def javascript(data, file_path, encode_base64, file_name, speakers):
+    speaker_ids = [
+        f'"IN_SPEAKER_{str(idx).zfill(2)}"'
+        for idx, speaker in enumerate(speakers)
+        if speaker != "unknown"
+    ]
+    speakers_array = "var speakers = Array(" + ", ".join(speaker_ids) + ")"
     content = """<script language="javascript">\n"""
     content += f'var fileName = "{file_name.split(".")[0]}"\n'
     content += """var source = Array(null, null, null, null, null)
@@ -302,16 +391,10 @@ var vid = document.getElementsByTagName("video")[0];
 vid.ontimeupdate = function() {highlightFunction()};"""
     content += "\n"
 
-    content += "var timestamps = "
-    timestamps = "Array("
-    for segment in data:
-        timestamps += f"Array({segment['start']}, {segment['end']}), "
-    if len(data) > 0:
-        timestamps = timestamps[:-2] + ");"
-    else:
-        timestamps += ");"
-    content += timestamps
-    content += "\n"
+    timestamps = ", ".join(
+        f"Array({segment['start']}, {segment['end']})" for segment in data
+    )
+    content += f"var timestamps = Array({timestamps});\n"
 
     content += """vid.currentTime = 0.0;
 highlightFunction();
@@ -0,0 +1,248 @@
+from collections import OrderedDict
+import threading
+import types
+
+import numpy as np
+from pyannote.audio import Pipeline
+from pyannote.core import SlidingWindow, SlidingWindowFeature
+import torch
+import whisperx
+from whisperx.audio import (
+    HOP_LENGTH,
+    N_FFT,
+    N_FRAMES,
+    N_SAMPLES,
+    SAMPLE_RATE,
+    mel_filters,
+)
+
+from backends import InferenceBackend
+
+
+def get_prompt(self, tokenizer, previous_tokens, without_timestamps, prefix):
+    prompt = []
+
+    if previous_tokens or prefix:
+        prompt.append(tokenizer.sot_prev)
+        if prefix:
+            hotwords_tokens = tokenizer.encode(" " + prefix.strip())
+            if len(hotwords_tokens) >= self.max_length // 2:
+                hotwords_tokens = hotwords_tokens[: self.max_length // 2 - 1]
+            prompt.extend(hotwords_tokens)
+        if prefix and previous_tokens:
+            prompt.extend(previous_tokens[-(self.max_length // 2 - 1) :])
+
+    prompt.extend(tokenizer.sot_sequence)
+
+    if without_timestamps:
+        prompt.append(tokenizer.no_timestamps)
+
+    return prompt
+
+
+class AlignModelCache:
+    # Process-wide cache of wav2vec2 alignment models keyed by language and device.
+    # At most max_size models stay loaded, the least recently used one is evicted.
+    def __init__(self, max_size=3):
+        self.max_size = max_size
+        self.models = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, language_code, device):
+        key = (language_code, device)
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                return self.models[key]
+
+            self.models[key] = whisperx.load_align_model(
+                language_code=language_code, device=device
+            )
+            while len(self.models) > self.max_size:
+                self.models.popitem(last=False)
+            return self.models[key]
+
+
+align_models = AlignModelCache()
+
+
+def log_mel_frames(audio, first_frame, last_frame, n_mels):
+    # Log-Mel frames [first_frame, last_frame) of the whole file, computed like
+    # whisperx.audio.log_mel_spectrogram but without its per-call normalization.
+    start = first_frame * HOP_LENGTH - N_FFT // 2
+    end = (last_frame - 1) * HOP_LENGTH + N_FFT // 2
+    chunk = np.pad(
+        audio[max(start, 0) : min(end, audio.shape[0])],
+        (max(-start, 0), max(end - audio.shape[0], 0)),
+        mode="reflect",
+    )
+    window = torch.hann_window(N_FFT)
+    stft = torch.stft(
+        torch.from_numpy(chunk),
+        N_FFT,
+        HOP_LENGTH,
+        window=window,
+        center=False,
+        return_complex=True,
+    )
+    mel_spec = mel_filters(stft.device, n_mels) @ (stft.abs() ** 2)
+    return torch.clamp(mel_spec, min=1e-10).log10()
+
+
+def detect_languages(audio, segments, model, batch_size=16):
+    # Detect the language of every segment. The spectrogram is computed once for the
+    # frames around a batch of segments and every 30 s window is sliced from it, the
+    # encoder and the language detection then run on the whole batch.
+    model_n_mels = model.model.feat_kwargs.get("feature_size")
+    n_mels = model_n_mels if model_n_mels is not None else 80
+
+    windows = []
+    for segment in segments:
+        start = max(int(segment["start"]) * SAMPLE_RATE - SAMPLE_RATE // 2, 0)
+        end = min(
+            (int(segment["end"]) + 1) * SAMPLE_RATE + SAMPLE_RATE // 2, audio.shape[0]
+        )
+        first_frame = start // HOP_LENGTH
+        windows.append(
+            (
+                first_frame,
+                first_frame + min(max(end - start, 0), N_SAMPLES) // HOP_LENGTH,
+            )
+        )
+
+    languages = []
+    for i in range(0, len(windows), batch_size):
+        batch_windows = windows[i : i + batch_size]
+        first_frame = min(first for first, _ in batch_windows)
+        last_frame = max(last for _, last in batch_windows)
+
+        # Frames missing at the end of the file are padded with silence (log10(1e-10)).
+        features = torch.full((len(batch_windows), n_mels, N_FRAMES), -10.0)
+        if last_frame > first_frame:
+            log_spec = log_mel_frames(audio, first_frame, last_frame, n_mels)
+            for j, (first, last) in enumerate(batch_windows):
+                features[j, :, : last - first] = log_spec[
+                    :, first - first_frame : last - first_frame
+                ]
+        features = torch.maximum(
+            features, features.amax(dim=(1, 2), keepdim=True) - 8.0
+        )
+        features = (features + 4.0) / 4.0
+
+        encoder_output = model.model.encode(features.numpy())
+        for results in model.model.model.detect_language(encoder_output):
+            language_token, language_probability = results[0]
+            languages.append((language_token[2:-2], language_probability))
+    return languages
+
+
+class CheckpointedVad:
+    # Wraps the voice activity detection of the whisperx pipeline. If checkpoints
+    # is set, the speech scores of the current audio are read from or stored in it.
+    def __init__(self, vad_model):
+        self.vad_model = vad_model
+        self.checkpoints = None
+
+    def __call__(self, inputs):
+        path = None
+        if self.checkpoints is not None:
+            path = self.checkpoints.path("vad.npz")
+        if path is not None and path.exists():
+            cached = np.load(path)
+            return SlidingWindowFeature(
+                cached["data"],
+                SlidingWindow(
+                    start=float(cached["start"]),
+                    duration=float(cached["duration"]),
+                    step=float(cached["step"]),
+                ),
+            )
+
+        scores = self.vad_model(inputs)
+        if self.checkpoints is not None:
+            window = scores.sliding_window
+            self.checkpoints.write(
+                "vad.npz",
+                lambda file: np.savez(
+                    file,
+                    data=scores.data,
+                    start=window.start,
+                    duration=window.duration,
+                    step=window.step,
+                ),
+            )
+        return scores
+
+
+class WhisperXBackend(InferenceBackend):
+    # whisperx large-v3 for the transcription, language detection and alignment,
+    # pyannote for the diarization.
+    def __init__(
+        self,
+        device,
+        hf_auth_token=None,
+        align_cache_size=3,
+        asr_threads=4,
+        torch_threads=0,
+    ):
+        self.device = device
+        align_models.max_size = align_cache_size
+        # On CPU the transcription (CTranslate2) and the PyTorch models (diarization,
+        # alignment, VAD) have separate thread pools, which can be sized so that a
+        # parallel diarization does not oversubscribe the cores.
+        if torch_threads > 0:
+            torch.set_num_threads(torch_threads)
+        compute_type = "float16" if device != "cpu" else "float32"
+        self.model = whisperx.load_model(
+            "large-v3",
+            device,
+            compute_type=compute_type,
+            download_root="models/whisperx",
+            threads=asr_threads,
+        )
+        self.model.model.get_prompt = types.MethodType(get_prompt, self.model.model)
+        self.model.vad_model = CheckpointedVad(self.model.vad_model)
+        self.diarize_model = Pipeline.from_pretrained(
+            "pyannote/speaker-diarization", use_auth_token=hf_auth_token
+        ).to(torch.device(device))
+
+    def preload(self, languages):
+        for language in languages:
+            align_models.get(language, self.device)
+
+    def transcribe(self, audio, hotwords, batch_size, checkpoints=None):
+        torch.cuda.empty_cache()
+        self.model.vad_model.checkpoints = checkpoints
+        if len(hotwords) > 0:
+            self.model.options = self.model.options._replace(prefix=" ".join(hotwords))
+        result = self.model.transcribe(audio, batch_size=batch_size, language="de")
+        if len(hotwords) > 0:
+            self.model.options = self.model.options._replace(prefix=None)
+        return result
+
+    def align(self, segments, language, audio):
+        model_a, metadata = align_models.get(language, self.device)
+        return whisperx.align(
+            segments,
+            model_a,
+            metadata,
+            audio,
+            self.device,
+            return_char_alignments=False,
+        )
+
+    def detect_languages(self, audio, segments, batch_size):
+        return detect_languages(audio, segments, self.model, batch_size=batch_size)
+
+    def diarize(self, audio, num_speakers):
+        audio_data = {
+            "waveform": torch.from_numpy(audio[None, :]),
+            "sample_rate": SAMPLE_RATE,
+        }
+        annotation = self.diarize_model(audio_data, num_speakers=num_speakers)
+        turns = [
+            (segment.start, segment.end, speaker)
+            for segment, _, speaker in annotation.itertracks(yield_label=True)
+        ]
+        torch.cuda.empty_cache()
+        return turns
@@ -2,6 +2,7 @@ import asyncio
 import base64
 import copy
 import datetime
+import json
 import os
 import shutil
 import time
@@ -82,6 +83,7 @@ async def handle_upload(e: events.UploadEventArguments, refresh_file_view):
             data = aiohttp.FormData()
             content = e.content.read()
             data.add_field("audio_file", content, filename=file_name)
+            data.add_field("user_id", user_id)
             for word in hotwords:
                 data.add_field("hotwords", word)
 
@@ -179,96 +181,130 @@ async def handle_upload_error(error, out_dir, error_dir, file_name):
         ui.notify("Ein unerwarteter Fehler ist aufgetreten", color="negative")
 
 
+# Status messages and progress shown while a file is processed, per pipeline stage
+STAGE_STATUS = {
+    "decode": ("Audio wird dekodiert...", 20.0),
+    "asr": ("Wird transkribiert...", 35.0),
+    "align": ("Zeitstempel werden berechnet...", 55.0),
+    "langid": ("Sprachen werden erkannt...", 65.0),
+    "diarize": ("Sprecher werden erkannt...", 75.0),
+    "diarize_wait": ("Sprecher werden erkannt...", 75.0),
+    "assign": ("Sprecher werden zugeordnet...", 80.0),
+    "srt": ("Ergebnis wird erstellt...", 85.0),
+    "viewer": ("Ergebnis wird erstellt...", 90.0),
+    "write": ("Ergebnis wird gespeichert...", 95.0),
+}
+
+
+async def save_result(session, request_id: str, out_dir: str):
+    """Download the finished transcription and store it next to the uploaded file,
+    or show an error if it is no longer available"""
+    file_name = app.storage.user.get("updates")[out_dir].filename
+
+    # Save transcription data, SRT and viewer HTML
+    for artifact, extension in [
+        ("transcription", ".json"),
+        ("srt", ".srt"),
+        ("viewer", ".html"),
+    ]:
+        async with session.get(f"{API_URL}/jobs/{request_id}/{artifact}") as response:
+            if response.status in (409, 410):
+                # The result was evicted, downloading it again will not help
+                app.storage.user.get("updates")[out_dir] = FileStatus.create_error(
+                    filename=file_name,
+                    out_dir=out_dir,
+                    last_modified=time.time(),
+                    error_message="Das Ergebnis ist nicht mehr verfügbar. Bitte die Datei erneut hochladen.",
+                )
+                return
+            response.raise_for_status()
+            async with aiofiles.open(
+                os.path.join(out_dir, file_name + extension), "wb"
+            ) as f:
+                async for chunk in response.content.iter_chunked(1024 * 1024):
+                    await f.write(chunk)
+
+    # Update UI status
+    app.storage.user.get("updates")[out_dir] = FileStatus.create_completed(
+        filename=file_name,
+        out_dir=out_dir,
+        last_modified=time.time(),
+    )
+
+
+def update_status(status: dict, out_dir: str):
+    """Show the status of a queued or running transcription"""
+    file_name = app.storage.user.get("updates")[out_dir].filename
+    if status["status"] == "processing":
+        status_message, progress_percentage = STAGE_STATUS.get(
+            status["stage"], ("Wird verarbeitet...", 50.0)
+        )
+        app.storage.user.get("updates")[out_dir] = FileStatus(
+            filename=file_name,
+            out_dir=out_dir,
+            status_message=status_message,
+            progress_percentage=progress_percentage,
+            estimated_time_remaining=status["estimated_processing_time"],
+            last_modified=time.time(),
+        )
+    else:
+        app.storage.user.get("updates")[out_dir] = FileStatus(
+            filename=file_name,
+            out_dir=out_dir,
+            status_message=f"In Warteschlange (Position {status['position']})",
+            progress_percentage=10.0,
+            estimated_time_remaining=status["estimated_wait_time"],
+            last_modified=time.time(),
+            queue_position=status["position"],
+        )
+
+
 async def poll_status(request_id: str, out_dir: str, refresh_file_view):
-    """Poll the API for transcription status"""
+    """Follow the transcription status through the API's event stream"""
+    # The API sends a keepalive every 15 seconds, a silent connection is dead.
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=60)
     while True:
         try:
-            logger.info(f"Polling transcription status with id {request_id}")
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f"{API_URL}/status/{request_id}") as response:
+            logger.info(f"Subscribing to transcription events with id {request_id}")
+            async with aiohttp.ClientSession(timeout=timeout) as session:
+                async with session.get(
+                    f"{API_URL}/jobs/{request_id}/events"
+                ) as response:
                     logger.info(f"Received response from API, status {response.status}")
-                    if response.status == 200:
-                        status = await response.json()
+                    if response.status == 404:
+                        # Request not found
+                        return
+
+                    async for line in response.content:
+                        line = line.decode("utf-8").strip()
+                        if not line.startswith("data:"):
+                            continue
+                        status = json.loads(line[len("data:") :])
                         logger.info(f"Transcription status: {status}")
 
                         if status["status"] == "completed":
-                            logger.info(f"Transcription status: {status["status"]}")
-                            # Handle completed transcription
-                            result = status["result"]
-                            file_name = app.storage.user.get("updates")[
-                                out_dir
-                            ].filename
-
-                            # Save transcription data
-                            async with aiofiles.open(
-                                os.path.join(out_dir, file_name + ".json"), "w"
-                            ) as f:
-                                await f.write(str(result["transcription"]))
-
-                            # Save SRT
-                            async with aiofiles.open(
-                                os.path.join(out_dir, file_name + ".srt"), "w"
-                            ) as f:
-                                await f.write(result["srt"])
-
-                            # Save viewer HTML
-                            async with aiofiles.open(
-                                os.path.join(out_dir, file_name + ".html"), "w"
-                            ) as f:
-                                await f.write(result["viewer"])
-
-                            # Update UI status
+                            await save_result(session, request_id, out_dir)
+                            refresh_file_view(refresh_queue=True, refresh_results=True)
+                            return
+                        elif status["status"] == "failed":
                             app.storage.user.get("updates")[out_dir] = (
-                                FileStatus.create_completed(
-                                    filename=file_name,
+                                FileStatus.create_error(
+                                    filename=app.storage.user.get("updates")[
+                                        out_dir
+                                    ].filename,
                                     out_dir=out_dir,
                                     last_modified=time.time(),
+                                    error_message=f"Verarbeitungsfehler: {status['error']}",
                                 )
                             )
                             refresh_file_view(refresh_queue=True, refresh_results=True)
-                            break
-
-                        elif status["status"] == "processing":
-                            logger.info(f"Transcription status: {status["status"]}")
-                            # Update processing status
-                            app.storage.user.get("updates")[out_dir] = FileStatus(
-                                filename=app.storage.user.get("updates")[
-                                    out_dir
-                                ].filename,
-                                out_dir=out_dir,
-                                status_message="Wird verarbeitet...",
-                                progress_percentage=50.0,
-                                estimated_time_remaining=status[
-                                    "estimated_processing_time"
-                                ],
-                                last_modified=time.time(),
-                            )
-
-                        else:
-                            logger.info(f"Transcription status: {status["status"]}")
-                            # Update queue status
-                            app.storage.user.get("updates")[out_dir] = FileStatus(
-                                filename=app.storage.user.get("updates")[
-                                    out_dir
-                                ].filename,
-                                out_dir=out_dir,
-                                status_message=f"In Warteschlange (Position {status['position']})",
-                                progress_percentage=10.0,
-                                estimated_time_remaining=status["estimated_wait_time"],
-                                last_modified=time.time(),
-                                queue_position=status["position"],
-                            )
+                            return
 
+                        update_status(status, out_dir)
                         refresh_file_view(refresh_queue=True, refresh_results=True)
 
-                    elif response.status == 404:
-                        # Request not found
-                        break
-
-            await asyncio.sleep(1)
-
         except Exception as e:
-            print(f"Error polling status: {e}")
+            print(f"Error following status: {e}")
             await asyncio.sleep(5)
 
 
@@ -334,7 +370,10 @@ setTimeout(function() {
 }, 100);
 </script>
 """
-        content = content.replace("</script>", video_content)
+        # Only the last script is the viewer's, with compact rows the transcript
+        # data and its renderer come before it.
+        head, _, tail = content.rpartition("</script>")
+        content = head + video_content + tail
 
     with open(html_file_name + "final", "w", encoding="utf-8") as f:
         f.write(content)